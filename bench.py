@@ -0,0 +1,459 @@
+# Load test za tok handle_text -> location_handler -> confirm_handler.
+#
+# Aplikacija iz main.build_app() dobija lazni Telegram API (FakeRequest), a
+# baza je BENCH_DATABASE_URL ili privremeni lokalni Postgres klaster
+# (initdb/pg_ctl iz PATH-a ili PG_BIN) - bez Docker-a.
+#
+# Sve tabele idu u posebnu semu (kurs_bench) koja se brise na pocetku.
+#
+#   python bench.py --users 200 --requests 5 --tg-latency 30
+#   python bench.py --check-indexes   # cesti upiti (main.HOT_QUERIES) idu preko indeksa
+#   python bench.py --parse 200000    # parse_request + validate_request, bez baze
+#   python bench.py --concurrency 20  # 20 istovremenih sporih upita kroz run_db - ne smeju ici redom
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BENCH_SCHEMA = "kurs_bench"
+BENCH_USER_BASE = 7_000_000_000
+
+
+# ================= POSTGRES ==================
+
+def start_temp_postgres():
+    pg_bin = os.getenv("PG_BIN")
+    initdb = os.path.join(pg_bin, "initdb") if pg_bin else shutil.which("initdb")
+    pg_ctl = os.path.join(pg_bin, "pg_ctl") if pg_bin else shutil.which("pg_ctl")
+    if not initdb or not pg_ctl:
+        sys.exit("Postavite BENCH_DATABASE_URL ili dodajte initdb/pg_ctl u PATH (ili PG_BIN).")
+
+    datadir = tempfile.mkdtemp(prefix="kurs-bench-pg-")
+    subprocess.run([initdb, "-D", datadir, "-U", "postgres", "-A", "trust"],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, "-D", datadir, "-w", "-l", os.path.join(datadir, "log"),
+                    "-o", f"-k {datadir} -c listen_addresses=''", "start"],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    def stop():
+        subprocess.run([pg_ctl, "-D", datadir, "-m", "fast", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(datadir, ignore_errors=True)
+
+    return f"postgresql://postgres@/postgres?host={datadir}", stop
+
+
+def prepare_schema(dsn):
+    import psycopg2
+
+    con = psycopg2.connect(dsn)
+    con.autocommit = True
+    with con.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    con.close()
+
+    from psycopg2.extensions import make_dsn
+    return make_dsn(dsn, options=f"-c search_path={BENCH_SCHEMA}")
+
+
+# ================= FAKE TELEGRAM ==================
+
+def make_fake_request(latency):
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # odgovara na Bot API pozive lokalno, uz opciono vestacko kasnjenje
+
+        def __init__(self):
+            self.calls = defaultdict(int)
+            self.message_id = 0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit("/", 1)[-1]
+            params = request_data.parameters if request_data else {}
+            self.calls[api_method] += 1
+
+            if latency:
+                await asyncio.sleep(latency)
+
+            if api_method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            elif api_method in ("sendMessage", "editMessageText"):
+                self.message_id += 1
+                result = {
+                    "message_id": self.message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id") or 1), "type": "private"},
+                    "text": params.get("text", ""),
+                }
+            else:
+                result = True
+
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeRequest()
+
+
+class UpdateFactory:
+
+    def __init__(self):
+        self.next_id = 0
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": "bench", "username": f"bench{uid}"}
+
+    def message(self, uid, text):
+        data = {
+            "update_id": self._id(),
+            "message": {
+                "message_id": self._id(),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": self._user(uid),
+                "text": text,
+            },
+        }
+        if text.startswith("/"):
+            data["message"]["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+        return data
+
+    def callback(self, uid, callback_data):
+        return {
+            "update_id": self._id(),
+            "callback_query": {
+                "id": str(self._id()),
+                "chat_instance": "bench",
+                "from": self._user(uid),
+                "data": callback_data,
+                "message": {
+                    "message_id": self._id(),
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "text": "bench",
+                },
+            },
+        }
+
+
+# ================= MEASUREMENT ==================
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def instrument_handlers(app, latencies):
+    # meri trajanje callback-a svakog registrovanog handlera
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            name = callback.__name__
+
+            async def timed(update, ctx, _callback=callback, _name=name):
+                t0 = time.perf_counter()
+                try:
+                    return await _callback(update, ctx)
+                finally:
+                    latencies[_name].append(time.perf_counter() - t0)
+
+            handler.callback = timed
+
+
+# ================= SCENARIO ==================
+
+def seed(main, users, location):
+    with main.db_cursor() as cur:
+        cur.executemany(
+            "INSERT INTO users(telegram_id, role, is_active, username) VALUES (%s, 'USER', 1, %s)",
+            [(uid, f"bench{uid}") for uid in users],
+        )
+        cur.execute("INSERT INTO locations(name) VALUES (%s)", (location,))
+    main.set_rate(117.0, 118.0, main.ADMIN_ID)
+
+
+def user_flow(factory, uid, main, requests_per_user):
+    # isti redosled kao pravi korisnik; PerUserUpdateProcessor cuva redosled po korisniku
+    loc_data = main.location_catalog.user_page(0).inline_keyboard[0][0].callback_data
+
+    updates = [factory.message(uid, "/kurs_evra")]
+    for i in range(requests_per_user):
+        updates.append(factory.message(uid, f"{1000 + i},EUR,117.5,18.00"))
+        updates.append(factory.callback(uid, loc_data))
+        updates.append(factory.callback(uid, main.encode_callback(main.CB_CONFIRM, nonce=i + 1)))
+    return updates
+
+
+async def run(args):
+    import main
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    main.init_db()
+
+    users = [BENCH_USER_BASE + i for i in range(args.users)]
+    seed(main, users, "Bench lokacija")
+    main.load_rate()
+    main.location_catalog.reload()
+    # baza je vec spremna - bez pozadinskog zagrevanja (lazy start) tokom merenja
+    main.startup.set_ready()
+
+    # lazni API nema flood limite
+    main.TG_GLOBAL_RATE = main.TG_PRIVATE_CHAT_RATE = main.TG_GROUP_CHAT_RATE = 1e6
+    main.notifier = main.Notifier(main.NOTIFY_WORKERS, main.NOTIFY_MAX_ATTEMPTS)
+    # update-ovi se prave unapred, pa n-ta potvrda korisnika ima nonce n
+    nonces = defaultdict(int)
+
+    async def ask_confirm(uid, action):
+        nonces[uid] += 1
+        action["nonce"] = nonces[uid]
+        await main.pending_confirm.set(uid, action)
+        return main.confirm_keyboard(nonces[uid])
+
+    main.ask_confirm = ask_confirm
+
+    fake = make_fake_request(args.tg_latency / 1000)
+    app = main.build_app(request=fake)
+
+    latencies = defaultdict(list)
+    instrument_handlers(app, latencies)
+
+    factory = UpdateFactory()
+    per_user = [user_flow(factory, uid, main, args.requests) for uid in users]
+    total = sum(len(u) for u in per_user)
+
+    done = asyncio.Event()
+    processed = 0
+
+    async def count(update, ctx):
+        nonlocal processed
+        processed += 1
+        if processed == total:
+            done.set()
+
+    app.add_handler(TypeHandler(Update, count), group=99)
+
+    await app.initialize()
+    await main.post_init(app)
+    await app.start()
+
+    # korisnici se prepliću kao u spicu: prvi update svih, pa drugi ...
+    queries_before = main.query_stats["count"]
+    t0 = time.perf_counter()
+    for step in range(max(len(u) for u in per_user)):
+        for updates in per_user:
+            if step < len(updates):
+                await app.update_queue.put(Update.de_json(updates[step], app.bot))
+
+    await asyncio.wait_for(done.wait(), args.timeout)
+    elapsed = time.perf_counter() - t0
+    queries = main.query_stats["count"] - queries_before
+
+    await app.stop()
+    await main.post_shutdown(app)
+    await app.shutdown()
+
+    with main.db_cursor() as cur:
+        cur.execute("SELECT count(*) FROM requests")
+        stored = cur.fetchone()[0]
+
+    report(args, latencies, total, elapsed, queries, stored, fake.calls)
+    main.close_pool()
+
+
+# (unos, ocekuje se da prodje)
+PARSE_SAMPLES = [
+    ("1000,EUR,117.5,18.00", True),
+    ("1000 EUR 117,5 18h", True),
+    ("250,5; usd/eur; 0,92; 9:30", True),
+    ("1000,EUR,130,18.00", False),       # kurs van granica
+    ("1000,EUR,117.5,25.00", False),     # rok van opsega
+    ("hiljadu,EUR,117.5,18.00", False),  # neispravan iznos
+    ("1,000,EUR,117.5,18.00", False),    # zarez u iznosu uz zarez kao separator
+    ("1000,EUR,117,18,00", False),       # zarez u roku uz zarez kao separator
+]
+
+
+def parse_bench(n):
+    # micro-benchmark: samo memorija (rate_book se puni rucno), bez baze i Telegram-a
+    import main
+
+    now = main.datetime.now()
+    main.rate_book.load([
+        ("EUR", 117.0, 118.0, now, 115, 122, 0.1, 4.0),
+        ("USD", 108.0, 109.5, now, 100, 120, 0.1, 4.0),
+    ])
+
+    print(f"{'unos':<32}{'ok':>6}{'us/poziv':>12}{'poziva/s':>12}")
+    total_calls, total_time, wrong = 0, 0.0, []
+    for text, expected in PARSE_SAMPLES:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            req, error = main.parse_request(text)
+            if req is not None:
+                error = main.validate_request(req)
+        elapsed = time.perf_counter() - t0
+        total_calls += n
+        total_time += elapsed
+        print(f"{text:<32}{'da' if error is None else 'ne':>6}{elapsed / n * 1e6:>12.2f}{n / elapsed:>12.0f}")
+        if (error is None) != expected:
+            wrong.append(text)
+
+    print(f"\nukupno: {total_calls / total_time:.0f} parse+validate/s")
+    return wrong
+
+
+def concurrency_check(n, latency):
+    # n "korisnika" istovremeno pokrece spor upit kroz run_db; ako bi se izvrsavali
+    # redom trajalo bi n * latency. Heartbeat meri da li je event loop za to vreme slobodan.
+    import main
+
+    def slow_query():
+        with main.db_cursor() as cur:
+            cur.execute("SELECT pg_sleep(%s)", (latency,))
+
+    async def go():
+        max_gap = 0.0
+        stop = asyncio.Event()
+
+        async def heartbeat():
+            nonlocal max_gap
+            last = time.perf_counter()
+            while not stop.is_set():
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                max_gap = max(max_gap, now - last)
+                last = now
+
+        beat = asyncio.create_task(heartbeat())
+        t0 = time.perf_counter()
+        await asyncio.gather(*(main.run_db(slow_query) for _ in range(n)))
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await beat
+        return elapsed, max_gap
+
+    main.get_pool()  # otvaranje poola ne ulazi u merenje
+    elapsed, max_gap = asyncio.run(go())
+    main.close_pool()
+
+    serial = n * latency
+    waves = -(-n // min(main.DB_WORKERS, main.DB_POOL_MAX))
+    print(f"korisnika:        {n} (DB_WORKERS={main.DB_WORKERS}, DB_POOL_MAX={main.DB_POOL_MAX})")
+    print(f"upit:             {latency * 1000:.0f} ms")
+    print(f"redom bi trajalo: {serial:.2f} s")
+    print(f"ocekivano:        {waves * latency:.2f} s ({waves} talasa)")
+    print(f"izmereno:         {elapsed:.2f} s")
+    print(f"event loop max:   {max_gap * 1000:.1f} ms izmedju heartbeat-a")
+
+    failures = []
+    if n > 1 and elapsed > serial / 2:
+        failures.append(f"upiti su serijalizovani ({elapsed:.2f}s >= {serial / 2:.2f}s)")
+    if max_gap > latency:
+        failures.append(f"event loop blokiran {max_gap * 1000:.0f} ms")
+    return failures
+
+
+def check_indexes():
+    import main
+
+    main.init_db()
+    failed = 0
+    for name, ok, nodes in main.check_indexes():
+        print(f"{'OK' if ok else 'SEQ':<6}{name:<28}{' -> '.join(nodes)}")
+        failed += not ok
+    main.close_pool()
+    return failed
+
+
+def report(args, latencies, total, elapsed, queries, stored, api_calls):
+    print(f"\nusers={args.users} requests/user={args.requests} tg_latency={args.tg_latency}ms "
+          f"concurrency={os.getenv('UPDATE_CONCURRENCY', '32')}\n")
+    print(f"{'handler':<32}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(latencies.items()):
+        print(f"{name:<32}{len(values):>8}"
+              f"{percentile(values, 50) * 1000:>10.2f}"
+              f"{percentile(values, 95) * 1000:>10.2f}"
+              f"{percentile(values, 99) * 1000:>10.2f}")
+
+    print()
+    print(f"updates:          {total}")
+    print(f"elapsed:          {elapsed:.2f} s")
+    print(f"throughput:       {total / elapsed:.1f} updates/s")
+    print(f"DB queries:       {queries} ({queries / total:.2f} po update-u)")
+    print(f"stored requests:  {stored} / {args.users * args.requests}")
+    print(f"Bot API calls:    {dict(api_calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="kurs-bot load test")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=3, help="zahteva po korisniku")
+    parser.add_argument("--tg-latency", type=float, default=0, help="kasnjenje laznog Bot API-ja (ms)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--check-indexes", action="store_true",
+                        help="samo proveri planove cestih upita (bez load testa)")
+    parser.add_argument("--parse", type=int, metavar="N",
+                        help="micro-benchmark parsera zahteva, N poziva po primeru (bez baze)")
+    parser.add_argument("--concurrency", type=int, metavar="N",
+                        help="N istovremenih sporih upita kroz run_db; pada ako idu redom")
+    parser.add_argument("--db-latency", type=float, default=200, help="trajanje sporog upita za --concurrency (ms)")
+    args = parser.parse_args()
+
+    if args.parse:
+        os.environ.setdefault("BOT_TOKEN", "1:bench")
+        wrong = parse_bench(args.parse)
+        if wrong:
+            sys.exit("Pogresno procitano: " + ", ".join(wrong))
+        return
+
+    stop = None
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if not dsn:
+        dsn, stop = start_temp_postgres()
+
+    try:
+        # main cita konfiguraciju pri importu
+        os.environ["DATABASE_URL"] = prepare_schema(dsn)
+        os.environ.setdefault("BOT_TOKEN", "1:bench")
+        os.environ.setdefault("NOTIFY_CHAT_IDS", "-1")
+        if args.check_indexes:
+            failed = check_indexes()
+            if failed:
+                sys.exit(f"{failed} upita bez indeksa")
+        elif args.concurrency:
+            failures = concurrency_check(args.concurrency, args.db_latency / 1000)
+            if failures:
+                sys.exit("FAIL: " + "; ".join(failures))
+            print("OK")
+        else:
+            asyncio.run(run(args))
+    finally:
+        if stop:
+            stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,235 +1,2327 @@
+import time
+
+# pocetak importa - od ovde se meri start (izvestaj o fazama starta)
+IMPORT_STARTED = time.perf_counter()
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-from datetime import datetime
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BaseUpdateProcessor, CallbackContext, CommandHandler, MessageHandler,
+    TypeHandler, filters, CallbackQueryHandler,
+)
+from telegram.request import BaseRequest, HTTPXRequest
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, time as dtime, timedelta
+from functools import partial, wraps
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import base64
+import binascii
+import contextvars
+import csv
+import io
 import re
 import os
+import secrets
+import select
+import struct
+import tempfile
+import threading
 import psycopg2
 import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2.extras import Json
 from telegram.ext import ContextTypes
 
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 8575573468
 
+# ===== UPDATE INGRESS =====
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # javni URL aplikacije, npr. https://kurs-bot.herokuapp.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # proverava X-Telegram-Bot-Api-Secret-Token
+PORT = int(os.getenv("PORT", "8443"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # npr. lokalni fake Telegram server: http://127.0.0.1:8081
+
+# ===== STARTUP =====
+# lazy: prijem update-ova krece odmah, a sema, pool i kesevi se pune u pozadini;
+# eager: sve pre pokretanja polling-a/webhook-a (staro ponasanje)
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")  # lazy | eager
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "5"))  # sekundi od importa do spremnosti; preko - upozorenje
+STARTUP_WAIT = float(os.getenv("STARTUP_WAIT", "10"))  # koliko update ceka spremnost pre odgovora "pokrece se"
+STARTUP_RETRY = 3  # sekundi izmedju pokusaja ako baza jos nije dostupna
+
+# ===== DB POOL =====
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # sekundi cekanja na slobodnu konekciju
+DB_HEALTHCHECK_IDLE = float(os.getenv("DB_HEALTHCHECK_IDLE", "60"))  # SELECT 1 ako konekcija duze stoji
+DB_WORKERS = int(os.getenv("DB_WORKERS", str(DB_POOL_MAX)))  # niti za blokirajuce psycopg2 pozive
+
+# ===== ROLE CACHE =====
+ROLE_CACHE_TTL = float(os.getenv("ROLE_CACHE_TTL", "300"))  # sekundi
+ROLE_CACHE_SIZE = int(os.getenv("ROLE_CACHE_SIZE", "10000"))
+
+# ===== CACHE COHERENCE =====
+# LISTEN na promene kursa i lokacija - potrebno samo kad radi vise instanci bota
+CACHE_LISTEN = os.getenv("CACHE_LISTEN", "0") == "1"
+RATE_CHANNEL = "rate_changed"
+LOCATIONS_CHANNEL = "locations_changed"
+
+# ===== REQUEST WRITER =====
+REQUEST_BATCH_SIZE = int(os.getenv("REQUEST_BATCH_SIZE", "50"))
+REQUEST_FLUSH_INTERVAL = float(os.getenv("REQUEST_FLUSH_INTERVAL", "1.0"))  # sekundi
+REQUEST_ANNOUNCE_TIMEOUT = float(os.getenv("REQUEST_ANNOUNCE_TIMEOUT", "10"))  # sekundi cekanja na id pre slanja bez dugmadi
+
+# ===== NOTIFICATIONS =====
+# ko dobija nove zahteve (admin + grupe/desk-ovi), odvojeno zarezom
+NOTIFY_CHAT_IDS = [
+    int(x) for x in os.getenv("NOTIFY_CHAT_IDS", f"{ADMIN_ID},-5021696516").split(",") if x.strip()
+]
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+
+# Telegram flood limiti: ~30 poruka/s ukupno, 1/s po privatnom chatu, 20/min po grupi
+TG_GLOBAL_RATE = 25.0
+TG_PRIVATE_CHAT_RATE = 1.0
+TG_GROUP_CHAT_RATE = 20 / 60
+
+# koliko update-ova bot obradjuje paralelno (update-ovi istog korisnika uvek idu redom)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# ===== SETTLEMENT =====
+# kada desk-ovi dobijaju stanje za dan (lokalno vreme HH:MM, odvojeno zarezom)
+SETTLEMENT_TIMES = [t.strip() for t in os.getenv("SETTLEMENT_TIMES", "09:00,13:00,17:00").split(",") if t.strip()]
+
+# ===== METRICS =====
+# Prometheus tekst na http://METRICS_HOST:METRICS_PORT/metrics (0 = iskljuceno)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# ===== LISTINGS =====
+USERS_PAGE_SIZE = 20
+PENDING_PAGE_SIZE = 10  # zahteva po stranici u /pending
+MY_REQUESTS_PAGE_SIZE = 10  # zahteva po stranici u /moji_zahtevi
+MY_REQUESTS_CACHE_TTL = 120  # sekundi; prva stranica /moji_zahtevi po korisniku
+MY_REQUESTS_CACHE_SIZE = 2000
+LOCATIONS_PAGE_SIZE = 8  # dugmadi po stranici u biranju lokacije
+
+# ===== RATE HISTORY =====
+RATE_HISTORY_SIZE = int(os.getenv("RATE_HISTORY_SIZE", "200"))  # poslednjih izmena kursa u memoriji
+RATE_HISTORY_SHOWN = 10  # izmena u /kurs_istorija
+
+# ===== BULK USER IMPORT =====
+IMPORT_MAX_ROWS = 5000  # redova u jednom CSV fajlu
+IMPORT_MAX_BYTES = 1024 * 1024
+
+# ===== CURRENCIES =====
+HOME_CURRENCY = "RSD"  # kurs svake valute je u RSD za 1 jedinicu
+DEFAULT_CURRENCY = "EUR"  # /kurs_evra i "RSD" bez para u zahtevu
+
 # ===== RATE SAFETY LIMITS =====
+# granice za EUR pri prvom pokretanju; posle se cuvaju po valuti u tabeli rates (/valuta)
 MIN_BUY_RATE = 115  # 115 RSD za 1 EUR
 MAX_BUY_RATE = 122  # 122 RSD za 1 EUR
 
 MIN_SPREAD = 0.1  # minimalna razlika buy/sell
 MAX_SPREAD = 4.0  # maksimalna razlika buy/sell
 
-# ===== GLOBAL CONFIRM STORAGE =====
-pending_confirm = {}
+# ===== CONVERSATION STATE =====
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # memory | postgres (deljeno izmedju instanci)
+STATE_TTL = float(os.getenv("STATE_TTL", "900"))  # sekundi do isteka nedovrsene akcije
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))  # po namespace-u, samo memory
+STATE_PURGE_INTERVAL = 60  # sekundi izmedju ciscenja isteklih stanja
+PROCESSED_ACTIONS_TTL = 86400  # sekundi koliko se pamti rezultat izvrsene potvrde
+
+
+# ================= METRICS ==================
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+class Histogram:
+    # Prometheus histogram sa (najvise) jednim label-om
+
+    def __init__(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label vrednost -> [brojaci po bucket-u..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+
+        for label_value, series in sorted(items, key=lambda x: str(x[0])):
+            base = f'{self.label}="{label_value}",' if self.label else ""
+            for bound, n in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {n}')
+            lines.append(f'{self.name}_bucket{{{base}le="+Inf"}} {series[-1]}')
+            labels = f"{{{base.rstrip(',')}}}" if base else ""
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+handler_latency = Histogram("kurs_handler_seconds", "Trajanje handlera", "handler")
+handler_db_queries = Histogram("kurs_handler_db_queries", "Broj DB upita po pozivu handlera", "handler", COUNT_BUCKETS)
+db_query_latency = Histogram("kurs_db_query_seconds", "Trajanje pojedinacnog DB upita")
+db_call_latency = Histogram("kurs_db_call_seconds", "Trajanje db() bloka (konekcija van poola)")
+telegram_api_latency = Histogram("kurs_telegram_api_seconds", "Trajanje Bot API poziva", "method")
+handler_errors = {}
+
+# brojac upita za handler koji se trenutno izvrsava (run_db prenosi context u db nit)
+_handler_queries = contextvars.ContextVar("handler_queries", default=None)
+
+
+def instrumented(func):
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(update, ctx):
+        queries = [0]
+        token = _handler_queries.set(queries)
+        t0 = time.perf_counter()
+        try:
+            return await func(update, ctx)
+        except ApplicationHandlerStop:
+            # namerno zaustavljanje obrade (npr. auth_stage dok se bot pokrece), nije greska
+            raise
+        except Exception:
+            handler_errors[name] = handler_errors.get(name, 0) + 1
+            raise
+        finally:
+            handler_latency.observe(name, time.perf_counter() - t0)
+            handler_db_queries.observe(name, queries[0])
+            _handler_queries.reset(token)
+    return wrapper
+
+
+def instrument_app(app):
+    # "middleware": meri svaki registrovani handler (i one iza private_only)
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumented(handler.callback)
+
+
+class InstrumentedRequest(BaseRequest):
+    # omotac oko HTTP sloja ka Telegram-u koji meri trajanje svakog Bot API poziva
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        t0 = time.perf_counter()
+        try:
+            return await self.inner.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        finally:
+            api_method = url.rsplit("/", 1)[-1]
+            telegram_api_latency.observe(api_method, time.perf_counter() - t0)
+            if api_method in REPLY_METHODS and startup.first_reply is None:
+                startup.mark_first_reply()
+
+
+def _gauge(name, help_text, value, kind="gauge", labels=""):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name}{labels} {value}"]
+
+
+def render_metrics():
+    lines = []
+    for hist in (handler_latency, handler_db_queries, db_query_latency, db_call_latency, telegram_api_latency):
+        lines += hist.render()
+
+    lines += ["# HELP kurs_handler_errors_total Izuzeci po handleru", "# TYPE kurs_handler_errors_total counter"]
+    for name, n in sorted(handler_errors.items()):
+        lines.append(f'kurs_handler_errors_total{{handler="{name}"}} {n}')
+
+    with _query_stats_lock:
+        lines += _gauge("kurs_db_queries_total", "Ukupno DB upita", query_stats["count"], "counter")
+
+    st = pool_stats()
+    lines += _gauge("kurs_db_pool_up", "Pool napravljen (baza bila dostupna)", st["up"])
+    lines += _gauge("kurs_db_pool_in_use", "Zauzete konekcije", st["in_use"])
+    lines += _gauge("kurs_db_pool_max_size", "Maksimalna velicina poola", st["max_size"])
+    lines += _gauge("kurs_db_pool_checkouts_total", "Uzimanja konekcije", st["checkouts"], "counter")
+    lines += _gauge("kurs_db_pool_wait_seconds_total", "Ukupno cekanje na konekciju", st["wait_seconds_total"], "counter")
+    lines += _gauge("kurs_db_pool_timeouts_total", "Isteklo cekanje na konekciju", st["timeouts"], "counter")
+
+    lines += ["# HELP kurs_pending_state_entries Nedovrsene akcije po store-u", "# TYPE kurs_pending_state_entries gauge"]
+    for store in (pending_confirm, pending_requests):
+        lines.append(f'kurs_pending_state_entries{{store="{store.namespace}"}} {store.size()}')
+
+    lines += _gauge("kurs_role_cache_hits_total", "Pogodci role cache-a", role_cache.hits, "counter")
+    lines += _gauge("kurs_role_cache_misses_total", "Promasaji role cache-a", role_cache.misses, "counter")
+    lines += _gauge("kurs_notify_queue_size", "Poruke koje cekaju slanje", notifier.size())
+    lines += _gauge("kurs_request_writer_buffer", "Zahtevi koji cekaju upis", request_writer.size())
+
+    lines += _gauge("kurs_startup_ready", "Bot spreman (sema, pool, kesevi)", int(startup.ready.is_set()))
+    lines += ["# HELP kurs_startup_seconds Trajanje faza starta", "# TYPE kurs_startup_seconds gauge"]
+    for phase, seconds in startup.report_items():
+        lines.append(f'kurs_startup_seconds{{phase="{phase}"}} {seconds:.4f}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Bot API metode koje znace odgovor korisniku (za "prvi odgovor" u izvestaju o startu)
+REPLY_METHODS = {"sendMessage", "editMessageText", "answerCallbackQuery", "sendDocument"}
+
+
+def start_metrics_server():
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
 
 
 # ================= DB ==================
 
+class PoolTimeout(Exception):
+    pass
+
+
+# broj i trajanje svih upita (preko pool konekcija)
+query_stats = {"count": 0, "seconds_total": 0.0}
+_query_stats_lock = threading.Lock()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - t0
+            with _query_stats_lock:
+                query_stats["count"] += 1
+                query_stats["seconds_total"] += elapsed
+            db_query_latency.observe(None, elapsed)
+
+            queries = _handler_queries.get()
+            if queries is not None:
+                queries[0] += 1
+
+
+def _zero_pool_stats():
+    return {
+        "checkouts": 0,
+        "in_use": 0,
+        "max_in_use": 0,
+        "wait_seconds_total": 0.0,
+        "wait_seconds_max": 0.0,
+        "use_seconds_total": 0.0,
+        "use_seconds_max": 0.0,
+        "timeouts": 0,
+        "discarded": 0,
+    }
+
+
+class DbPool:
+    # ThreadedConnectionPool baca PoolError kad je pun, zato ispred stoji semafor
+    # koji ceka na slobodno mesto (do DB_POOL_TIMEOUT) umesto da puca.
+
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_idle):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn, cursor_factory=CountingCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._checked_out = {}
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.stats = _zero_pool_stats()
+
+    def _healthy(self, con):
+        if con.closed:
+            return False
+
+        last = self._last_used.get(id(con))
+        if last is not None and time.monotonic() - last < self.healthcheck_idle:
+            return True
+
+        try:
+            with con.cursor() as cur:
+                cur.execute("SELECT 1")
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        t0 = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise PoolTimeout(f"Nema slobodne DB konekcije posle {self.timeout}s")
+
+        waited = time.monotonic() - t0
+        try:
+            con = self._pool.getconn()
+            if not self._healthy(con):
+                self._discard(con)
+                con = self._pool.getconn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            st = self.stats
+            st["checkouts"] += 1
+            st["in_use"] += 1
+            st["max_in_use"] = max(st["max_in_use"], st["in_use"])
+            st["wait_seconds_total"] += waited
+            st["wait_seconds_max"] = max(st["wait_seconds_max"], waited)
+
+        self._checked_out[id(con)] = time.monotonic()
+        return con
+
+    def putconn(self, con, close=False):
+        now = time.monotonic()
+        used = now - self._checked_out.pop(id(con), now)
+
+        try:
+            if close or con.closed:
+                self._discard(con)
+            else:
+                self._last_used[id(con)] = now
+                self._pool.putconn(con)
+        finally:
+            self._slots.release()
+            with self._lock:
+                st = self.stats
+                st["in_use"] -= 1
+                st["use_seconds_total"] += used
+                st["use_seconds_max"] = max(st["use_seconds_max"], used)
+            db_call_latency.observe(None, used)
+
+    def _discard(self, con):
+        self._last_used.pop(id(con), None)
+        with self._lock:
+            self.stats["discarded"] += 1
+        self._pool.putconn(con, close=True)
+
+    def close(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = DbPool(
+                    os.getenv("DATABASE_URL"),
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    DB_POOL_TIMEOUT,
+                    DB_HEALTHCHECK_IDLE,
+                )
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def pool_stats():
+    # ne pravi pool (zove se i iz metrics niti); dok pool ne postoji sve je 0
+    pool = _pool
+    if pool is None:
+        st = _zero_pool_stats()
+        st["up"] = 0
+        st["min_size"] = 0
+        st["max_size"] = 0
+        return st
+
+    with pool._lock:
+        st = dict(pool.stats)
+    st["up"] = 1
+    st["min_size"] = pool.minconn
+    st["max_size"] = pool.maxconn
+    return st
+
+
+@contextmanager
 def db():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
+    # konekcija iz poola; commit na kraju bloka, rollback na gresku
+    pool = get_pool()
+    con = pool.getconn()
+    broken = False
+    try:
+        yield con
+        con.commit()
+    except BaseException as e:
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            broken = True
+        else:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        pool.putconn(con, close=broken)
+
+
+@contextmanager
+def db_cursor():
+    with db() as con:
+        with con.cursor() as cur:
+            yield cur
+
+
+# psycopg2 je blokirajuci - svi DB pozivi iz handlera idu kroz ovaj executor,
+# tako da spor upit ne zaustavlja event loop (i ostale chat-ove)
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # context ide sa pozivom, da se upiti pripisu handleru koji ih je pokrenuo
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, partial(ctx.run, fn, *args, **kwargs))
+
+
+# ================= MIGRATIONS ==================
+# (verzija, opis, koraci); korak je SQL ili (SQL, parametri).
+# Primenjene verzije se pamte u schema_version - postojece migracije se ne menjaju,
+# izmena seme ide kao nova verzija na kraj liste.
+# Prve tri verzije su raniji init_db (IF NOT EXISTS), pa prolaze i na postojecoj bazi.
+MIGRATIONS = [
+    (1, "users, rate, locations, requests, bot_state", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            role TEXT CHECK(role IN ('USER','ADMIN')) NOT NULL,
+            is_active INTEGER DEFAULT 1,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # dodavanje admina
+        ("""
+        INSERT INTO users(telegram_id, role, is_active, username)
+        VALUES (%s, 'ADMIN', 1, 'admin')
+        ON CONFLICT (telegram_id) DO NOTHING
+        """, (ADMIN_ID,)),
+        # RATE (stara tabela, samo EUR; izvor za prelazak na rates)
+        """
+        CREATE TABLE IF NOT EXISTS rate (
+            id INTEGER PRIMARY KEY,
+            buy_rate REAL,
+            sell_rate REAL,
+            updated_at TIMESTAMP,
+            updated_by BIGINT REFERENCES users(telegram_id)
+        )
+        """,
+        "INSERT INTO rate (id) VALUES (1) ON CONFLICT (id) DO NOTHING",
+        """
+        CREATE TABLE IF NOT EXISTS locations (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE,
+            is_active INTEGER DEFAULT 1
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS requests (
+            id SERIAL PRIMARY KEY,
+            created_by BIGINT REFERENCES users(telegram_id),
+            amount REAL,
+            currency TEXT,
+            target_currency TEXT,
+            rate_requested REAL,
+            due_time TEXT,
+            location_id INTEGER REFERENCES locations(id),
+            status TEXT CHECK(status IN ('DRAFT','SENT','APPROVED','REJECTED')) DEFAULT 'DRAFT',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            admin_note TEXT
+        )
+        """,
+        # CONVERSATION STATE (STATE_BACKEND=postgres)
+        """
+        CREATE TABLE IF NOT EXISTS bot_state (
+            namespace TEXT NOT NULL,
+            key BIGINT NOT NULL,
+            value JSONB NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (namespace, key)
+        )
+        """,
+    ]),
+    (2, "rates po valuti, rate_history, rate_stats", [
+        # RATES - kurs po valuti (RSD za 1 jedinicu) i granice za njegov unos
+        """
+        CREATE TABLE IF NOT EXISTS rates (
+            currency TEXT PRIMARY KEY,
+            buy_rate REAL,
+            sell_rate REAL,
+            updated_at TIMESTAMP,
+            updated_by BIGINT REFERENCES users(telegram_id),
+            min_buy REAL NOT NULL,
+            max_buy REAL NOT NULL,
+            min_spread REAL NOT NULL,
+            max_spread REAL NOT NULL
+        )
+        """,
+        # EUR iz stare tabele rate
+        ("""
+        INSERT INTO rates(currency, buy_rate, sell_rate, updated_at, updated_by,
+                          min_buy, max_buy, min_spread, max_spread)
+        SELECT %s, buy_rate, sell_rate, updated_at, updated_by, %s, %s, %s, %s
+        FROM rate WHERE id=1
+        ON CONFLICT (currency) DO NOTHING
+        """, (DEFAULT_CURRENCY, MIN_BUY_RATE, MAX_BUY_RATE, MIN_SPREAD, MAX_SPREAD)),
+        # RATE HISTORY - svaka izmena kursa, samo INSERT
+        """
+        CREATE TABLE IF NOT EXISTS rate_history (
+            id BIGSERIAL PRIMARY KEY,
+            currency TEXT NOT NULL,
+            buy_rate REAL NOT NULL,
+            sell_rate REAL NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            updated_by BIGINT
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS rate_history_currency_updated_at
+        ON rate_history(currency, updated_at)
+        """,
+        # kurs postavljen pre uvodjenja istorije
+        """
+        INSERT INTO rate_history(currency, buy_rate, sell_rate, updated_at, updated_by)
+        SELECT currency, buy_rate, sell_rate, updated_at, updated_by FROM rates
+        WHERE buy_rate IS NOT NULL AND updated_at IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM rate_history)
+        """,
+        # agregati po valuti i danu/nedelji; azuriraju se pri svakom upisu u istoriju
+        """
+        CREATE TABLE IF NOT EXISTS rate_stats (
+            currency TEXT,
+            period TEXT CHECK(period IN ('day','week')),
+            period_start DATE,
+            n INTEGER NOT NULL,
+            buy_min REAL, buy_max REAL, buy_sum DOUBLE PRECISION,
+            sell_min REAL, sell_max REAL, sell_sum DOUBLE PRECISION,
+            spread_min REAL, spread_max REAL, spread_sum DOUBLE PRECISION,
+            PRIMARY KEY (currency, period, period_start)
+        )
+        """,
+    ]),
+    (3, "obrada zahteva, settlement, desk, processed_actions", [
+        # otvoreni zahtevi (red za /pending) - mali indeks, raste samo sa neobradjenim
+        "CREATE INDEX IF NOT EXISTS requests_open ON requests(id) WHERE status = 'SENT'",
+        # SETTLEMENT - koliko koja lokacija treba da spremi po valuti za dan;
+        # menja se inkrementalno sa svakim zahtevom/odbijanjem
+        """
+        CREATE TABLE IF NOT EXISTS settlement (
+            day DATE,
+            location_id INTEGER REFERENCES locations(id),
+            currency TEXT,
+            amount DOUBLE PRECISION NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (day, location_id, currency)
+        )
+        """,
+        # desk (grupa) koji dobija stanje lokacije
+        "ALTER TABLE locations ADD COLUMN IF NOT EXISTS desk_chat_id BIGINT",
+        # valute vise nisu ogranicene na EUR/RSD
+        "ALTER TABLE requests DROP CONSTRAINT IF EXISTS requests_currency_check",
+        "ALTER TABLE requests ADD COLUMN IF NOT EXISTS target_currency TEXT",
+        # obracun dana (rebuild_settlement): otvoreni zahtevi po danu, lokaciji i roku
+        """
+        CREATE INDEX IF NOT EXISTS requests_settlement
+        ON requests(created_at, location_id, due_time)
+        WHERE status IN ('SENT','APPROVED')
+        """,
+        # IDEMPOTENCY - potvrde koje su vec izvrsene (dupli klik, ponovljen callback)
+        """
+        CREATE TABLE IF NOT EXISTS processed_actions (
+            uid BIGINT NOT NULL,
+            nonce BIGINT NOT NULL,
+            result TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (uid, nonce)
+        )
+        """,
+    ]),
+    (4, "indeksi za ceste upite (HOT_QUERIES)", [
+        # zahtevi korisnika; i provera pre brisanja korisnika (delete_users)
+        "CREATE INDEX IF NOT EXISTS requests_created_by ON requests(created_by)",
+        # obradjeni zahtevi po statusu i vremenu
+        "CREATE INDEX IF NOT EXISTS requests_status_created_at ON requests(status, created_at)",
+        # LocationCatalog.reload - isti redosled kao ORDER BY, bez sortiranja
+        "CREATE INDEX IF NOT EXISTS locations_active_name ON locations(is_active DESC, name)",
+        # /list_users sa filterom po roli (keyset po telegram_id)
+        "CREATE INDEX IF NOT EXISTS users_role_telegram_id ON users(role, telegram_id)",
+        # periodicno ciscenje isteklog stanja
+        "CREATE INDEX IF NOT EXISTS processed_actions_created_at ON processed_actions(created_at)",
+        "CREATE INDEX IF NOT EXISTS bot_state_expires_at ON bot_state(expires_at)",
+    ]),
+    (5, "istorija zahteva po korisniku (/moji_zahtevi)", [
+        # keyset po (created_at, id) - zahtevi iz istog batch-a imaju isto created_at
+        """
+        CREATE INDEX IF NOT EXISTS requests_created_by_created_at
+        ON requests(created_by, created_at DESC, id DESC)
+        """,
+        # pokriven novim indeksom
+        "DROP INDEX IF EXISTS requests_created_by",
+    ]),
+    (6, "uklonjen indeks bez upita", [
+        # nijedan upit ne filtrira po (status, created_at): /pending ide preko requests_open,
+        # stanje preko requests_settlement
+        "DROP INDEX IF EXISTS requests_status_created_at",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# isti kljuc za sve instance - migracije radi samo jedna, ostale cekaju
+MIGRATION_LOCK_ID = 72_001
 
 
 def init_db():
-    con = db()
-    cur = con.cursor()
-
-    # USERS
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        telegram_id BIGINT PRIMARY KEY,
-        role TEXT CHECK(role IN ('USER','ADMIN')) NOT NULL,
-        is_active INTEGER DEFAULT 1,
-        username TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-
-    # dodavanje admina
-    cur.execute("""
-    INSERT INTO users(telegram_id, role, is_active, username)
-    VALUES (%s, 'ADMIN', 1, 'admin')
-    ON CONFLICT (telegram_id) DO NOTHING
-    """, (ADMIN_ID,))
-
-    # RATE
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS rate (
-        id INTEGER PRIMARY KEY,
-        buy_rate REAL,
-        sell_rate REAL,
-        updated_at TIMESTAMP,
-        updated_by BIGINT REFERENCES users(telegram_id)
-    )
-    """)
-
-    cur.execute("""
-    INSERT INTO rate (id)
-    VALUES (1)
-    ON CONFLICT (id) DO NOTHING
-    """)
-
-    # LOCATIONS
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS locations (
-        id SERIAL PRIMARY KEY,
-        name TEXT UNIQUE,
-        is_active INTEGER DEFAULT 1
-    )
-    """)
-
-    # REQUESTS
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS requests (
-        id SERIAL PRIMARY KEY,
-        created_by BIGINT REFERENCES users(telegram_id),
-        amount REAL,
-        currency TEXT CHECK(currency IN ('EUR','RSD')),
-        rate_requested REAL,
-        due_time TEXT,
-        location_id INTEGER REFERENCES locations(id),
-        status TEXT CHECK(status IN ('DRAFT','SENT','APPROVED','REJECTED')) DEFAULT 'DRAFT',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        admin_note TEXT
-    )
-    """)
+    # na startu jedan upit; migracije se pokrecu samo kada baza zaostaje
+    with db() as con:
+        with con.cursor() as cur:
+            try:
+                cur.execute("SELECT max(version) FROM schema_version")
+                current = cur.fetchone()[0] or 0
+            except psycopg2.errors.UndefinedTable:
+                con.rollback()
+                current = 0
+
+    if current < SCHEMA_VERSION:
+        migrate()
+
+
+def migrate():
+    # sve nove verzije u jednoj transakciji - pad usred migracije ne ostavlja pola seme
+    with db_cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+        cur.execute("SELECT version FROM schema_version")
+        applied = {r[0] for r in cur.fetchall()}
+
+        for version, description, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            for step in steps:
+                sql, params = (step, None) if isinstance(step, str) else step
+                cur.execute(sql, params)
+            cur.execute(
+                "INSERT INTO schema_version(version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            print(f"Migracija {version}: {description}")
+
+
+# ================= CACHE ==================
+
+_MISSING = object()
+
+
+class TTLCache:
+    # LRU sa istekom; koristi se i iz event loop-a i iz db niti, zato lock
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=_MISSING):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            item = self._data.pop(key, None)
+        if item is None or item[1] < time.monotonic():
+            return default
+        return item[0]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def purge(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (_, exp) in self._data.items() if exp < now]
+            for k in expired:
+                del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# telegram_id -> role (None = nema pristup); kesira se i negativan rezultat,
+# ADD_USER/DELETE_USER ga eksplicitno brisu
+role_cache = TTLCache(ROLE_CACHE_TTL, ROLE_CACHE_SIZE)
+
+# telegram_id -> prva stranica /moji_zahtevi (redovi, ima_jos); brise se kad se
+# zahtevi korisnika upisu ili obrade, TTL pokriva izmene sa drugih instanci
+recent_requests = TTLCache(MY_REQUESTS_CACHE_TTL, MY_REQUESTS_CACHE_SIZE)
+
+
+# ================= STATE STORE ==================
+# pending_confirm / pending_requests: uid -> JSON vrednost, sa istekom
+
+class MemoryStateStore:
+
+    def __init__(self, namespace, ttl, maxsize):
+        self.namespace = namespace
+        self._cache = TTLCache(ttl, maxsize)
+        self._last_purge = time.monotonic()
 
-    con.commit()
-    con.close()
+    async def get(self, uid):
+        value = self._cache.get(uid)
+        return None if value is _MISSING else value
+
+    async def set(self, uid, value):
+        self._cache.set(uid, value)
+        if time.monotonic() - self._last_purge > STATE_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            self._cache.purge()
+
+    async def pop(self, uid):
+        value = self._cache.pop(uid)
+        return None if value is _MISSING else value
+
+    async def contains(self, uid):
+        return await self.get(uid) is not None
+
+    def size(self):
+        return len(self._cache)
+
+
+STATE_GET_SQL = """
+    SELECT value FROM bot_state
+    WHERE namespace=%s AND key=%s AND expires_at > now()
+"""
+STATE_PURGE_SQL = "DELETE FROM bot_state WHERE expires_at <= now()"
+
+
+class PostgresStateStore:
+    # stanje u tabeli bot_state, tako da vise instanci bota (i restart) vide isto
+
+    def __init__(self, namespace, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._last_purge = time.monotonic()
+
+    def _get(self, uid):
+        with db_cursor() as cur:
+            cur.execute(STATE_GET_SQL, (self.namespace, uid))
+            r = cur.fetchone()
+        return r[0] if r else None
+
+    def _set(self, uid, value):
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO bot_state(namespace, key, value, expires_at)
+                VALUES (%s, %s, %s, now() + %s * interval '1 second')
+                ON CONFLICT (namespace, key)
+                DO UPDATE SET value=EXCLUDED.value, expires_at=EXCLUDED.expires_at
+            """, (self.namespace, uid, Json(value), self.ttl))
+
+            if time.monotonic() - self._last_purge > STATE_PURGE_INTERVAL:
+                self._last_purge = time.monotonic()
+                cur.execute(STATE_PURGE_SQL)
+
+    def _pop(self, uid):
+        with db_cursor() as cur:
+            cur.execute("""
+                DELETE FROM bot_state
+                WHERE namespace=%s AND key=%s
+                RETURNING value, expires_at > now()
+            """, (self.namespace, uid))
+            r = cur.fetchone()
+        return r[0] if r and r[1] else None
+
+    async def get(self, uid):
+        return await run_db(self._get, uid)
+
+    async def set(self, uid, value):
+        await run_db(self._set, uid, value)
+
+    async def pop(self, uid):
+        return await run_db(self._pop, uid)
+
+    async def contains(self, uid):
+        return await self.get(uid) is not None
+
+    def size(self):
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT count(*) FROM bot_state
+                WHERE namespace=%s AND expires_at > now()
+            """, (self.namespace,))
+            return cur.fetchone()[0]
+
+
+def make_state_store(namespace):
+    if STATE_BACKEND == "postgres":
+        return PostgresStateStore(namespace, STATE_TTL)
+    return MemoryStateStore(namespace, STATE_TTL, STATE_MAX_ENTRIES)
+
+
+# akcija koja ceka Potvrdi/Otkaži
+pending_confirm = make_state_store("confirm")
+
+# uneti zahtev koji ceka izbor lokacije
+pending_requests = make_state_store("request")
+
+
+PROCESSED_ACTION_SQL = "SELECT result FROM processed_actions WHERE uid=%s AND nonce=%s"
+PROCESSED_ACTIONS_PURGE_SQL = "DELETE FROM processed_actions WHERE created_at < now() - %s * interval '1 second'"
+
+
+class ProcessedActions:
+    # (uid, nonce) izvrsenih potvrda; PRIMARY KEY garantuje da akciju izvrsi
+    # samo prvi klik, i kad se callback-ovi obradjuju na vise instanci
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._last_purge = time.monotonic()
+
+    def claim(self, uid, nonce):
+        # True = ovaj poziv izvrsava akciju
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO processed_actions(uid, nonce) VALUES (%s, %s)
+                ON CONFLICT (uid, nonce) DO NOTHING
+                RETURNING uid
+            """, (uid, nonce))
+            claimed = cur.fetchone() is not None
+
+            if time.monotonic() - self._last_purge > STATE_PURGE_INTERVAL:
+                self._last_purge = time.monotonic()
+                cur.execute(PROCESSED_ACTIONS_PURGE_SQL, (self.ttl,))
+        return claimed
+
+    def finish(self, uid, nonce, result):
+        with db_cursor() as cur:
+            cur.execute("UPDATE processed_actions SET result=%s WHERE uid=%s AND nonce=%s", (result, uid, nonce))
+
+    def release(self, uid, nonce):
+        # akcija nije uspela - moze ponovo
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM processed_actions WHERE uid=%s AND nonce=%s", (uid, nonce))
+
+    def lookup(self, uid, nonce):
+        # (True, rezultat ili None dok se izvrsava) / (False, None)
+        with db_cursor() as cur:
+            cur.execute(PROCESSED_ACTION_SQL, (uid, nonce))
+            r = cur.fetchone()
+        return (True, r[0]) if r else (False, None)
+
+
+processed_actions = ProcessedActions(PROCESSED_ACTIONS_TTL)
+
+
+# ================= CALLBACK DATA ==================
+# callback_data dugmadi = base64(verzija, akcija, id, nonce), 14 znakova bez
+# obzira na duzinu naziva lokacije (Telegram limit je 64 bajta); id je
+# location_id ili id zahteva, zavisno od akcije
+
+CB_VERSION = 2  # 2: nonce 32 bita (kljuc za processed_actions)
+
+CB_LOC = 1           # korisnik bira lokaciju
+CB_LOC_ENABLE = 2    # admin ukljucuje lokaciju
+CB_LOC_DISABLE = 3   # admin iskljucuje lokaciju
+CB_CONFIRM = 4
+CB_CANCEL = 5
+CB_APPROVE = 6       # admin odobrava zahtev
+CB_REJECT = 7        # admin odbija zahtev
+CB_APPROVE_LIST = 8  # isto, iz /pending liste (posle odluke se lista osvezava)
+CB_REJECT_LIST = 9
+
+_cb_struct = struct.Struct(">BBII")
+
+
+def encode_callback(action, target_id=0, nonce=0):
+    raw = _cb_struct.pack(CB_VERSION, action, target_id, nonce)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_callback(data):
+    # (akcija, id, nonce) ili None za stari/strani format
+    if not isinstance(data, str) or len(data) != 14:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data + "==")
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != _cb_struct.size:
+        return None
+    version, action, target_id, nonce = _cb_struct.unpack(raw)
+    if version != CB_VERSION:
+        return None
+    return action, target_id, nonce
+
+
+def callback_pattern(*actions):
+    # pattern za CallbackQueryHandler
+    def match(data):
+        decoded = decode_callback(data)
+        return decoded is not None and decoded[0] in actions
+    return match
+
+
+def new_nonce():
+    return secrets.randbits(32)
 
 
 # ================= HELPERS ==================
 
+GET_USER_SQL = "SELECT role, is_active FROM users WHERE telegram_id=%s"
+
+
 def get_user(user_id):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT role, is_active FROM users WHERE telegram_id=%s", (user_id,))
-    r = cur.fetchone()
-    con.close()
+    with db_cursor() as cur:
+        cur.execute(GET_USER_SQL, (user_id,))
+        r = cur.fetchone()
     return r  # (role, is_active) or None
 
 
-def get_role(uid):
+def load_role(uid):
     u = get_user(uid)
-    return u[0] if u and u[1] == 1 else None
+    role = u[0] if u and u[1] == 1 else None
+    role_cache.set(uid, role)
+    return role
 
 
-def is_admin(uid):
-    return get_role(uid) == "ADMIN"
+async def get_role_async(uid):
+    # cache hit ne ide kroz executor
+    role = role_cache.get(uid)
+    if role is not _MISSING:
+        return role
+    return await run_db(load_role, uid)
 
 
-def get_rate():
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT buy_rate, sell_rate, updated_at FROM rate WHERE id=1")
-    r = cur.fetchone()
-    con.close()
-    if not r or r[0] is None or r[1] is None:
-        return None
-    return r
+class RateBook:
+    # kursevi svih valuta u memoriji + matrica konverzije za svaki par valuta
+    # (ukljucujuci kros kurseve); pravi se ponovo samo kad se kurs ili granice
+    # promene, pa zahtev u bilo kom paru ne ide u bazu
+
+    def __init__(self):
+        self.rates = {}   # valuta -> (buy, sell, updated_at), RSD za 1 jedinicu
+        self.limits = {}  # valuta -> (min_buy, max_buy, min_spread, max_spread)
+        self.matrix = {}  # (donosi, dobija) -> (buy, sell), u jedinicama osnovne valute para
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        with self._lock:
+            rates, limits = {}, {}
+            for currency, buy, sell, updated_at, *currency_limits in rows:
+                limits[currency] = tuple(currency_limits)
+                if buy is not None and sell is not None:
+                    rates[currency] = (buy, sell, updated_at)
+            self._publish(rates, limits)
+
+    def update(self, currency, buy, sell, updated_at):
+        with self._lock:
+            rates = dict(self.rates)
+            rates[currency] = (buy, sell, updated_at)
+            self._publish(rates, self.limits)
+
+    def _publish(self, rates, limits):
+        matrix = {}
+        for currency, (buy, sell, _) in rates.items():
+            matrix[(currency, HOME_CURRENCY)] = (buy, sell)
+            matrix[(HOME_CURRENCY, currency)] = (buy, sell)
+
+        # kros kurs: b za 1 a; menjacnica kupuje a po buy_a, a prodaje b po sell_b
+        for a, (buy_a, sell_a, _) in rates.items():
+            for b, (buy_b, sell_b, _) in rates.items():
+                if a != b:
+                    matrix[(a, b)] = (buy_a / sell_b, sell_a / buy_b)
 
+        # citaoci uzimaju reference, nikad ne vide pola izgradjenu matricu
+        self.rates, self.limits, self.matrix = rates, limits, matrix
 
-def get_locations():
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT name FROM locations WHERE is_active=1")
-    r = [x[0] for x in cur.fetchall()]
-    con.close()
-    return r
+    def quote(self, frm, to):
+        return self.matrix.get((frm, to))
+
+
+rate_book = RateBook()
+
+
+# poslednje izmene po valuti za ring buffer (index na (currency, updated_at))
+RECENT_RATE_HISTORY_SQL = """
+    SELECT r.currency, h.buy_rate, h.sell_rate, h.updated_at
+    FROM rates r
+    CROSS JOIN LATERAL (
+        SELECT buy_rate, sell_rate, updated_at FROM rate_history
+        WHERE currency = r.currency
+        ORDER BY updated_at DESC LIMIT %s
+    ) h
+    ORDER BY h.updated_at
+"""
+
+
+def load_rate():
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT currency, buy_rate, sell_rate, updated_at, min_buy, max_buy, min_spread, max_spread
+            FROM rates
+        """)
+        rows = cur.fetchall()
+
+        cur.execute(RECENT_RATE_HISTORY_SQL, (RATE_HISTORY_SIZE,))
+        recent = cur.fetchall()
+
+    rate_book.load(rows)
+    rate_history.replace(recent)
+    return get_rate()
+
+
+def get_rate(currency=DEFAULT_CURRENCY):
+    # (buy, sell, updated_at) ili None, iz memorije
+    return rate_book.rates.get(currency)
+
+
+CURRENCY_RE = re.compile(r"^[A-Z]{3}$")
+
+
+def convert(amount, frm, to, kurs):
+    # kurs je uvek za 1 jedinicu osnovne valute para: strana valuta prema RSD,
+    # odnosno valuta koju klijent donosi u kros paru
+    return amount / kurs if frm == HOME_CURRENCY else amount * kurs
+
+
+class RateHistory:
+    # ring buffer poslednjih RATE_HISTORY_SIZE izmena kursa po valuti (najstarija prva)
+
+    def __init__(self, size):
+        self.size = size
+        self._items = {}  # valuta -> deque
+        self._lock = threading.Lock()
+
+    def append(self, currency, buy, sell, updated_at):
+        with self._lock:
+            items = self._items.setdefault(currency, deque(maxlen=self.size))
+            items.append((buy, sell, updated_at))
+
+    def replace(self, rows):
+        items = {}
+        for currency, buy, sell, updated_at in rows:
+            items.setdefault(currency, deque(maxlen=self.size)).append((buy, sell, updated_at))
+        with self._lock:
+            self._items = items
+
+    def recent(self, currency, n):
+        with self._lock:
+            return list(self._items.get(currency, ()))[-n:]
+
+
+rate_history = RateHistory(RATE_HISTORY_SIZE)
+
+
+def rate_periods(dt):
+    # (period, pocetak) kojima izmena pripada
+    day = dt.date()
+    return [("day", day), ("week", day - timedelta(days=day.weekday()))]
+
+
+RATE_STATS_SQL = """
+    SELECT period, n, buy_min, buy_max, buy_sum / n, sell_min, sell_max, sell_sum / n,
+           spread_min, spread_max, spread_sum / n
+    FROM rate_stats
+    WHERE currency = %s AND (period, period_start) IN (%s, %s)
+"""
+
+
+def get_rate_stats(currency, dt):
+    # {period: (n, buy_min, buy_max, buy_avg, sell_min, sell_max, sell_avg,
+    #           spread_min, spread_max, spread_avg)}; jedan PK lookup po periodu
+    with db_cursor() as cur:
+        cur.execute(RATE_STATS_SQL, (currency, *rate_periods(dt)))
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def _cache_listener():
+    reloaders = {
+        RATE_CHANNEL: load_rate,
+        LOCATIONS_CHANNEL: location_catalog.reload,
+    }
+
+    # posebna konekcija van poola, blokira na select() dok ne stigne NOTIFY
+    while True:
+        con = None
+        try:
+            con = psycopg2.connect(os.getenv("DATABASE_URL"))
+            con.autocommit = True
+            with con.cursor() as cur:
+                for channel in reloaders:
+                    cur.execute(f"LISTEN {channel}")
+
+            # mozda smo propustili promenu dok konekcija nije postojala
+            for reload in reloaders.values():
+                reload()
+
+            while True:
+                if select.select([con], [], [], 60) == ([], [], []):
+                    continue
+                con.poll()
+                channels = {n.channel for n in con.notifies}
+                con.notifies.clear()
+                for channel in channels:
+                    reloaders[channel]()
+
+        except psycopg2.Error as e:
+            print("Cache listener error:", e)
+            time.sleep(5)
+
+        finally:
+            if con is not None:
+                con.close()
+
+
+def start_cache_listener():
+    threading.Thread(target=_cache_listener, name="cache-listener", daemon=True).start()
+
+
+def paginate(rows, size):
+    return [rows[i:i + size] for i in range(0, len(rows), size)] or [[]]
+
+
+def nav_row(prefix, page, pages):
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}{page - 1}"))
+    if pages > 1:
+        row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{prefix}{page}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}{page + 1}"))
+    return row
+
+
+def user_locations_keyboard(rows, page=0, pages=1, extra_row=None):
+    keyboard = [
+        [InlineKeyboardButton(name, callback_data=encode_callback(CB_LOC, loc_id))]
+        for loc_id, name in rows
+    ]
+    nav = nav_row("LOCPG:", page, pages)
+    if nav:
+        keyboard.append(nav)
+    if extra_row:
+        keyboard.append(extra_row)
+    return InlineKeyboardMarkup(keyboard)
+
+
+class LocationCatalog:
+    # sve lokacije u memoriji + gotove tastature po stranicama; pravi se ponovo
+    # samo kad se lokacije promene (ADD_LOCATION, enable/disable). Pretraga po
+    # pocetku naziva ide bisect-om kroz sortiranu listu (in-memory indeks).
+
+    def __init__(self):
+        self.rows = []  # (id, name, is_active), ORDER BY is_active DESC, name
+        self.by_id = {}
+        self.by_name = {}
+        self.active_names = []
+        self.active_rows = []  # (id, name)
+        self.user_pages = [InlineKeyboardMarkup([])]
+        self.admin_pages = []  # (tekst, tastatura)
+        self._index = []  # (lower(name), name, id, is_active), sortirano
+        self._lock = threading.Lock()
+
+    def reload(self):
+        rows = get_all_locations()
+
+        with self._lock:
+            self.rows = rows
+            self.by_id = {loc_id: (name, active) for loc_id, name, active in rows}
+            self.by_name = {name: loc_id for loc_id, name, _ in rows}
+            self.active_names = [name for _, name, active in rows if active]
+            self.active_rows = [(loc_id, name) for loc_id, name, active in rows if active]
+
+            user_pages = paginate(self.active_rows, LOCATIONS_PAGE_SIZE)
+            self.user_pages = [
+                user_locations_keyboard(page_rows, i, len(user_pages)) for i, page_rows in enumerate(user_pages)
+            ]
+
+            admin_pages = paginate(rows, LOCATIONS_PAGE_SIZE)
+            self.admin_pages = [
+                (admin_locations_text(page_rows, i, len(admin_pages)),
+                 admin_locations_keyboard(page_rows, i, len(admin_pages)))
+                for i, page_rows in enumerate(admin_pages)
+            ] if rows else []
+
+            self._index = sorted((name.lower(), name, loc_id, active) for loc_id, name, active in rows)
+
+    def user_page(self, page):
+        pages = self.user_pages
+        return pages[max(0, min(page, len(pages) - 1))]
+
+    def admin_page(self, page):
+        pages = self.admin_pages
+        return pages[max(0, min(page, len(pages) - 1))]
+
+    def admin_page_of(self, loc_id):
+        for i, row in enumerate(self.rows):
+            if row[0] == loc_id:
+                return i // LOCATIONS_PAGE_SIZE
+        return 0
+
+    def search(self, prefix, active_only=True, limit=LOCATIONS_PAGE_SIZE):
+        # vraca (redovi, ima_jos); cita najvise limit+1 pogodaka
+        key = prefix.strip().lower()
+        index = self._index
+        found = []
+        i = bisect_left(index, (key,))
+        while i < len(index) and index[i][0].startswith(key) and len(found) <= limit:
+            _, name, loc_id, active = index[i]
+            if active or not active_only:
+                found.append((loc_id, name, active))
+            i += 1
+        return found[:limit], len(found) > limit
+
+
+location_catalog = LocationCatalog()
+
+
+def set_rate(buy, sell, uid, currency=DEFAULT_CURRENCY):
+    updated_at = datetime.now()
+    spread = sell - buy
+    with db_cursor() as cur:
+        cur.execute("""
+            UPDATE rates SET buy_rate=%s, sell_rate=%s, updated_at=%s, updated_by=%s
+            WHERE currency=%s
+        """, (buy, sell, updated_at, uid, currency))
+        cur.execute("""
+            INSERT INTO rate_history(currency, buy_rate, sell_rate, updated_at, updated_by)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (currency, buy, sell, updated_at, uid))
+
+        # dan i nedelja se azuriraju inkrementalno, bez citanja istorije
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO rate_stats AS s (currency, period, period_start, n,
+                buy_min, buy_max, buy_sum, sell_min, sell_max, sell_sum,
+                spread_min, spread_max, spread_sum)
+            VALUES %s
+            ON CONFLICT (currency, period, period_start) DO UPDATE SET
+                n = s.n + 1,
+                buy_min = LEAST(s.buy_min, EXCLUDED.buy_min),
+                buy_max = GREATEST(s.buy_max, EXCLUDED.buy_max),
+                buy_sum = s.buy_sum + EXCLUDED.buy_sum,
+                sell_min = LEAST(s.sell_min, EXCLUDED.sell_min),
+                sell_max = GREATEST(s.sell_max, EXCLUDED.sell_max),
+                sell_sum = s.sell_sum + EXCLUDED.sell_sum,
+                spread_min = LEAST(s.spread_min, EXCLUDED.spread_min),
+                spread_max = GREATEST(s.spread_max, EXCLUDED.spread_max),
+                spread_sum = s.spread_sum + EXCLUDED.spread_sum
+        """, [
+            (currency, period, start, 1, buy, buy, buy, sell, sell, sell, spread, spread, spread)
+            for period, start in rate_periods(updated_at)
+        ])
+
+        # ostale instance osvezavaju snapshot (isporucuje se tek na commit)
+        cur.execute("SELECT pg_notify(%s, '')", (RATE_CHANNEL,))
+
+    rate_book.update(currency, buy, sell, updated_at)
+    rate_history.append(currency, buy, sell, updated_at)
+
+
+def set_currency_limits(currency, min_buy, max_buy, min_spread, max_spread):
+    # nova valuta (bez kursa) ili nove granice postojece
+    with db_cursor() as cur:
+        cur.execute("""
+            INSERT INTO rates(currency, min_buy, max_buy, min_spread, max_spread)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (currency) DO UPDATE
+            SET min_buy=EXCLUDED.min_buy, max_buy=EXCLUDED.max_buy,
+                min_spread=EXCLUDED.min_spread, max_spread=EXCLUDED.max_spread
+        """, (currency, min_buy, max_buy, min_spread, max_spread))
+        cur.execute("SELECT pg_notify(%s, '')", (RATE_CHANNEL,))
+    load_rate()
+
+
+def validate_rate(currency, buy, sell):
+    limits = rate_book.limits.get(currency)
+    if limits is None:
+        return f"❌ Valuta {currency} nije dodata. Dodajte je sa /valuta."
+    min_buy, max_buy, min_spread, max_spread = limits
+
+    # ===== BASIC LOGIC CHECK =====
+    if buy >= sell:
+        return "❌ Kupovni kurs mora biti manji od prodajnog."
+
+    # ===== RANGE CHECK =====
+    if not (min_buy <= buy <= max_buy):
+        return f"❌ Kupovni kurs mora biti između {min_buy} i {max_buy} RSD."
+
+    spread = sell - buy
+    if not (min_spread <= spread <= max_spread):
+        return f"❌ Razlika kupovni/prodajni mora biti između {min_spread} i {max_spread}."
+
+    return None
+
+
+def insert_user(tgid, role, username):
+    with db_cursor() as cur:
+        # deaktiviran korisnik (ima zahteve ili izmene kursa) se ponovo aktivira
+        cur.execute("""
+            INSERT INTO users(telegram_id, role, is_active, username)
+            VALUES (%s, %s, 1, %s)
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET role=EXCLUDED.role, username=EXCLUDED.username, is_active=1
+            WHERE users.is_active=0
+            RETURNING telegram_id
+        """, (tgid, role, username))
+        return cur.fetchone() is not None
+
+
+def delete_user(tgid):
+    # "DELETED", "DEACTIVATED" (na korisnika upucuju zahtevi ili izmene kursa) ili None
+    try:
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id=%s RETURNING telegram_id", (tgid,))
+            return "DELETED" if cur.fetchone() else None
+
+    except psycopg2.errors.ForeignKeyViolation:
+        with db_cursor() as cur:
+            cur.execute("UPDATE users SET is_active=0 WHERE telegram_id=%s", (tgid,))
+        return "DEACTIVATED"
+
+
+def insert_users(rows):
+    # jedna transakcija, jedan INSERT za sve redove (telegram_id, role, username, is_active);
+    # postojeci korisnici se preskacu, osim deaktiviranog sa is_active=1 (kao /add);
+    # ponovni uvoz /export_users zato nikoga ne aktivira. Vraca (upisano, od toga neaktivnih)
+    with db_cursor() as cur:
+        inserted = psycopg2.extras.execute_values(cur, """
+            INSERT INTO users(telegram_id, role, username, is_active)
+            VALUES %s
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET role=EXCLUDED.role, username=EXCLUDED.username, is_active=1
+            WHERE users.is_active=0 AND EXCLUDED.is_active=1
+            RETURNING is_active
+        """, rows, page_size=len(rows), fetch=True)
+    return len(inserted), sum(1 for (active,) in inserted if not active)
+
+
+def delete_users(tgids):
+    # kao delete_user, ali za vise korisnika u jednoj transakciji: brisu se samo
+    # korisnici na koje ne upucuje nijedan FK (zahtevi, izmene kursa), ostali se
+    # deaktiviraju. Vraca (obrisano, deaktivirano)
+    with db_cursor() as cur:
+        cur.execute("""
+            DELETE FROM users u
+            WHERE u.telegram_id = ANY(%s)
+              AND NOT EXISTS (SELECT 1 FROM requests r WHERE r.created_by = u.telegram_id)
+              AND NOT EXISTS (SELECT 1 FROM rates r WHERE r.updated_by = u.telegram_id)
+              AND NOT EXISTS (SELECT 1 FROM rate r WHERE r.updated_by = u.telegram_id)
+        """, (tgids,))
+        deleted = cur.rowcount
+
+        cur.execute("""
+            UPDATE users SET is_active=0
+            WHERE telegram_id = ANY(%s) AND is_active=1
+        """, (tgids,))
+        deactivated = cur.rowcount
+    return deleted, deactivated
+
+
+def export_users_csv(f):
+    # COPY direktno u fajl, redovi ne prolaze kroz Python objekte
+    with db_cursor() as cur:
+        cur.copy_expert(
+            "COPY (SELECT telegram_id, role, username, is_active FROM users ORDER BY telegram_id) "
+            "TO STDOUT WITH CSV HEADER",
+            f
+        )
+
+
+def insert_location(name):
+    with db_cursor() as cur:
+        cur.execute("INSERT INTO locations(name) VALUES(%s) ON CONFLICT (name) DO NOTHING", (name,))
+        cur.execute("SELECT pg_notify(%s, '')", (LOCATIONS_CHANNEL,))
+    location_catalog.reload()
+
+
+def users_page_query(anchor=None, backward=False, role=None, active=None, limit=USERS_PAGE_SIZE):
+    # (sql, params) za get_users_page; isti upit proverava i check_indexes
+    where = []
+    params = []
+    if anchor is not None:
+        where.append("telegram_id < %s" if backward else "telegram_id > %s")
+        params.append(anchor)
+    if role:
+        where.append("role = %s")
+        params.append(role)
+    if active is not None:
+        where.append("is_active = %s")
+        params.append(active)
+
+    sql = "SELECT telegram_id, role, username, is_active FROM users"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY telegram_id " + ("DESC" if backward else "ASC") + " LIMIT %s"
+    params.append(limit + 1)
+    return sql, params
+
+
+def get_users_page(anchor=None, backward=False, role=None, active=None, limit=USERS_PAGE_SIZE):
+    # keyset po telegram_id; vraca (redovi, ima_jos) - uzima se limit+1 red
+    # da bi se znalo da li postoji sledeca stranica u tom smeru
+    sql, params = users_page_query(anchor, backward, role, active, limit)
+
+    rows = []
+    with db() as con:
+        # server-side cursor - redovi se citaju u delovima, ne odjednom
+        with con.cursor(name="users_page") as cur:
+            cur.itersize = limit + 1
+            cur.execute(sql, params)
+            for row in cur:
+                rows.append(row)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+DECIDE_REQUEST_SQL = """
+    UPDATE requests SET status=%s, admin_note=%s
+    WHERE id=%s AND status='SENT'
+    RETURNING created_by, amount, currency, rate_requested, location_id, target_currency, created_at
+"""
+
+
+def decide_request(request_id, status, note):
+    # SENT -> APPROVED/REJECTED; uslovni UPDATE, pa od dva admina koji kliknu
+    # istovremeno prolazi samo prvi. Vraca (created_by, None) ili (None, trenutni status)
+    with db_cursor() as cur:
+        cur.execute(DECIDE_REQUEST_SQL, (status, note, request_id))
+        r = cur.fetchone()
+        if r:
+            created_by, amount, currency, rate, location_id, target, created_at = r
+            # odbijen zahtev se vise ne sprema
+            if status == "REJECTED" and location_id is not None and target is not None:
+                add_settlement(cur, {
+                    (created_at.date(), location_id, target): (-convert(amount, currency, target, rate), -1)
+                })
+            return created_by, None
+
+        cur.execute("SELECT status FROM requests WHERE id=%s", (request_id,))
+        r = cur.fetchone()
+        return None, r[0] if r else None
+
+
+PENDING_PAGE_SQL = """
+    SELECT r.id, r.amount, r.currency, r.target_currency, r.rate_requested, r.due_time,
+           r.location_id, r.created_by, u.username
+    FROM requests r
+    LEFT JOIN users u ON u.telegram_id = r.created_by
+    WHERE r.status = 'SENT' AND r.id > %s
+    ORDER BY r.id
+    LIMIT %s
+"""
+PENDING_COUNT_SQL = "SELECT count(*) FROM requests WHERE status = 'SENT'"
+
+
+def get_pending_page(anchor=0, limit=PENDING_PAGE_SIZE):
+    # keyset po id preko parcijalnog indeksa requests_open; (redovi, ima_jos, ukupno)
+    with db_cursor() as cur:
+        cur.execute(PENDING_PAGE_SQL, (anchor, limit + 1))
+        rows = cur.fetchall()
+
+        cur.execute(PENDING_COUNT_SQL)
+        total = cur.fetchone()[0]
+
+    return rows[:limit], len(rows) > limit, total
+
+
+def user_requests_page_query(uid, anchor=None, limit=MY_REQUESTS_PAGE_SIZE):
+    # (sql, params) za get_user_requests_page; isti upit proverava i check_indexes
+    sql = """
+        SELECT id, amount, currency, target_currency, rate_requested, due_time,
+               location_id, status, created_at
+        FROM requests
+        WHERE created_by = %s
+    """
+    params = [uid]
+    if anchor is not None:
+        sql += " AND (created_at, id) < (SELECT created_at, id FROM requests WHERE id = %s)"
+        params.append(anchor)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT %s"
+    params.append(limit + 1)
+    return sql, params
+
+
+def get_user_requests_page(uid, anchor=None, limit=MY_REQUESTS_PAGE_SIZE):
+    # najnoviji prvi; keyset (created_at, id) preko requests_created_by_created_at.
+    # anchor = id poslednjeg prikazanog zahteva; (redovi, ima_jos)
+    sql, params = user_requests_page_query(uid, anchor, limit)
+
+    with db_cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+ALL_LOCATIONS_SQL = "SELECT id, name, is_active FROM locations ORDER BY is_active DESC, name"
+
+
+def get_all_locations():
+    with db_cursor() as cur:
+        cur.execute(ALL_LOCATIONS_SQL)
+        return cur.fetchall()
+
+
+def set_location_active(loc_id, active):
+    with db_cursor() as cur:
+        cur.execute("UPDATE locations SET is_active=%s WHERE id=%s", (1 if active else 0, loc_id))
+        cur.execute("SELECT pg_notify(%s, '')", (LOCATIONS_CHANNEL,))
+    location_catalog.reload()
+
+
+# ================= REQUEST WRITER ==================
+
+def insert_requests(rows):
+    # jedan multi-row INSERT za ceo batch; RETURNING vraca id-jeve istim redom
+    with db_cursor() as cur:
+        inserted = psycopg2.extras.execute_values(cur, """
+            INSERT INTO requests(created_by, amount, currency, rate_requested, due_time, location_id,
+                                 target_currency, status)
+            VALUES %s
+            RETURNING id, created_at
+        """, rows, template="(%s, %s, %s, %s, %s, %s, %s, 'SENT')", page_size=len(rows), fetch=True)
+
+        # running total za dan, u istoj transakciji; dan je iz created_at (sat baze),
+        # isto kao u decide_request i rebuild_settlement
+        totals = {}
+        for (_, amount, currency, rate, _, location_id, target), (_, created_at) in zip(rows, inserted):
+            if location_id is None or target is None:
+                continue
+            key = (created_at.date(), location_id, target)
+            total, n = totals.get(key, (0.0, 0))
+            totals[key] = (total + convert(amount, currency, target, rate), n + 1)
+        add_settlement(cur, totals)
+
+    for created_by, *_ in rows:
+        recent_requests.invalidate(created_by)
+    return [request_id for request_id, _ in inserted]
+
+
+class RequestWriter:
+    # zahtevi se skupljaju u memoriji i upisuju u batch-u kad se skupi
+    # REQUEST_BATCH_SIZE komada ili istekne REQUEST_FLUSH_INTERVAL
+
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._buffer = []  # (row, future)
+        self._inflight = []  # batch koji se upravo upisuje
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def submit(self, created_by, amount, currency, rate, due_time, location_id, target_currency):
+        # future dobija id reda posle flush-a (None ako upis nije uspeo)
+        fut = asyncio.get_running_loop().create_future()
+        self._buffer.append(((created_by, amount, currency, rate, due_time, location_id, target_currency), fut))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+        return fut
+
+    async def flush(self):
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+        self._inflight = batch
+        try:
+            ids = await self._insert(batch)
+        finally:
+            self._inflight = []
+        if ids is None:
+            return
+
+        for (_, fut), request_id in zip(batch, ids):
+            if not fut.done():
+                fut.set_result(request_id)
+
+    async def _insert(self, batch):
+        # id-jevi istim redom kao batch; None ako je batch vracen u buffer
+        try:
+            return await run_db(insert_requests, [row for row, _ in batch])
+
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            # baza nedostupna - vrati u buffer, probace se na sledecem flush-u
+            print("Request writer error, retrying:", e)
+            self._buffer[:0] = batch
+            return None
+
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            # los je neki red (npr. korisnik obrisan dok je zahtev cekao) - upisi
+            # red po red da propadne samo taj
+            return await self._insert_one_by_one(batch)
+
+        except psycopg2.Error as e:
+            print("Request writer error, dropping batch of", len(batch), "requests:", e)
+            return [None] * len(batch)
+
+    async def _insert_one_by_one(self, batch):
+        ids = []
+        for i, (row, _) in enumerate(batch):
+            try:
+                ids.extend(await run_db(insert_requests, [row]))
+            except (psycopg2.OperationalError, PoolTimeout) as e:
+                # baza pala usred ponavljanja - upisani dobijaju id, ostali nazad u buffer
+                print("Request writer error, retrying:", e)
+                for (_, fut), request_id in zip(batch, ids):
+                    if not fut.done():
+                        fut.set_result(request_id)
+                self._buffer[:0] = batch[i:]
+                return None
+            except psycopg2.Error as e:
+                print("Request writer error, dropping request of user", row[0], ":", e)
+                ids.append(None)
+        return ids
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            stopping = self._stopping
+            await self.flush()
+            if stopping:
+                return
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    def size(self):
+        return len(self._buffer)
+
+    async def stop(self, timeout=10):
+        # poslednji upis; ako baza ne odgovori za timeout, odustani - sta nije
+        # upisano dobija None, da niko ne ceka future zauvek
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self.flush())
+        await asyncio.wait({self._task}, timeout=timeout)
+
+        pending = self._buffer + self._inflight
+        self._buffer = []
+        if not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+        if pending:
+            print("Request writer stopped, requests not stored:", len(pending))
+        for _, fut in pending:
+            if not fut.done():
+                fut.set_result(None)
+
+
+request_writer = RequestWriter(REQUEST_BATCH_SIZE, REQUEST_FLUSH_INTERVAL)
+
+
+# ================= NOTIFICATIONS ==================
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # uzima token odmah (i "na dug"), vraca koliko treba sacekati pre slanja
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        # posle RetryAfter - sledeci token tek za `seconds`
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Notifier:
+    # red poruka za admina/grupe; vise worker-a salje paralelno, a token bucket-i
+    # (globalni + po chatu) drze nas ispod Telegram flood limita
+
+    def __init__(self, workers, max_attempts):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._queue = asyncio.Queue()
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats = {}
+        self._tasks = []
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = TG_GROUP_CHAT_RATE if chat_id < 0 else TG_PRIVATE_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, 3)
+        return bucket
+
+    def enqueue(self, chat_id, text, **kwargs):
+        self._queue.put_nowait((chat_id, text, kwargs, 1))
+
+    def broadcast(self, text, chat_ids=None, **kwargs):
+        for chat_id in (NOTIFY_CHAT_IDS if chat_ids is None else chat_ids):
+            self.enqueue(chat_id, text, **kwargs)
+
+    async def _send(self, chat_id, text, kwargs, attempt):
+        delay = max(self._global.reserve(), self._bucket(chat_id).reserve())
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            await self.bot.send_message(chat_id, text, **kwargs)
+
+        except RetryAfter as e:
+            if attempt >= self.max_attempts:
+                print("Notify dropped (flood):", chat_id)
+                return
+            self._bucket(chat_id).pause(e.retry_after)
+            self._queue.put_nowait((chat_id, text, kwargs, attempt + 1))
+
+        except NetworkError as e:
+            if attempt >= self.max_attempts:
+                print("Notify dropped:", chat_id, e)
+                return
+            await asyncio.sleep(2 ** attempt)
+            self._queue.put_nowait((chat_id, text, kwargs, attempt + 1))
+
+        except TelegramError as e:
+            # npr. bot izbacen iz grupe - nema smisla ponavljati
+            print("Notify failed:", chat_id, e)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, attempt = await self._queue.get()
+            try:
+                await self._send(chat_id, text, kwargs, attempt)
+            finally:
+                self._queue.task_done()
+
+    def start(self, bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        # pokusaj da posaljes ono sto je ostalo u redu
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print("Notify queue not drained:", self._queue.qsize())
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def size(self):
+        return self._queue.qsize()
+
+
+notifier = Notifier(NOTIFY_WORKERS, NOTIFY_MAX_ATTEMPTS)
+
+
+def request_keyboard(request_id, from_list=False):
+    approve, reject = (CB_APPROVE_LIST, CB_REJECT_LIST) if from_list else (CB_APPROVE, CB_REJECT)
+    return [
+        InlineKeyboardButton("✅ Odobri", callback_data=encode_callback(approve, request_id)),
+        InlineKeyboardButton("❌ Odbij", callback_data=encode_callback(reject, request_id)),
+    ]
+
+
+async def announce_request(fut, msg, uid):
+    # ceka id iz batch upisa pa salje zahtev sa dugmadima za odluku; ako baza
+    # ne odgovara, posle REQUEST_ANNOUNCE_TIMEOUT salje bez dugmadi (odluka ide
+    # kroz /pending kad se upis zavrsi), da task ne visi i ne koci gasenje
+    try:
+        request_id = await asyncio.wait_for(asyncio.shield(fut), REQUEST_ANNOUNCE_TIMEOUT)
+    except asyncio.TimeoutError:
+        notifier.enqueue(uid, "⚠️ Zahtev još nije upisan u bazu, admin ga vidi bez dugmadi.")
+        return notifier.broadcast(msg + "\n\n⚠️ Zahtev još nije upisan u bazu; kad se upiše biće u /pending.")
+
+    if request_id is None:
+        notifier.enqueue(uid, "❌ Zahtev nije upisan u bazu. Pošalji ga ponovo.")
+        return notifier.broadcast(msg + "\n\n⚠️ Zahtev nije upisan u bazu.")
+
+    notifier.broadcast(
+        f"{msg}\n\nZahtev #{request_id}",
+        reply_markup=InlineKeyboardMarkup([request_keyboard(request_id)])
+    )
+
+
+# ================= SETTLEMENT ==================
+# stanje za dan: po lokaciji i valuti koliko treba spremiti za otvorene
+# (SENT/APPROVED) zahteve. Tabela settlement se azurira sa svakim zahtevom,
+# pa izvestaj cita samo redove za taj dan.
+
+def add_settlement(cur, totals):
+    # totals: (dan, location_id, valuta) -> (iznos, broj zahteva); deo tekuce transakcije
+    if not totals:
+        return
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO settlement AS s (day, location_id, currency, amount, n)
+        VALUES %s
+        ON CONFLICT (day, location_id, currency) DO UPDATE
+        SET amount = s.amount + EXCLUDED.amount, n = s.n + EXCLUDED.n
+    """, [
+        (day, location_id, currency, amount, n)
+        for (day, location_id, currency), (amount, n) in totals.items()
+    ])
+
+
+def db_today():
+    # dan po satu baze, isti kao created_at.date() u insert_requests
+    with db_cursor() as cur:
+        cur.execute("SELECT current_date")
+        return cur.fetchone()[0]
+
+
+REBUILD_SETTLEMENT_SQL = """
+    INSERT INTO settlement(day, location_id, currency, amount, n)
+    SELECT %s, location_id, target_currency,
+           SUM(CASE WHEN currency = %s THEN amount / rate_requested ELSE amount * rate_requested END),
+           count(*)
+    FROM requests
+    WHERE status IN ('SENT','APPROVED')
+      AND created_at >= %s AND created_at < %s
+      AND location_id IS NOT NULL AND target_currency IS NOT NULL
+    GROUP BY location_id, target_currency
+"""
+
+
+def rebuild_settlement(day=None):
+    # jedan GROUP BY nad zahtevima tog dana (index requests_settlement);
+    # poziva se na startu da stanje bude usaglaseno sa tabelom requests
+    with db_cursor() as cur:
+        if day is None:
+            cur.execute("SELECT current_date")
+            day = cur.fetchone()[0]
+        start = datetime.combine(day, dtime())
+        cur.execute("DELETE FROM settlement WHERE day=%s", (day,))
+        cur.execute(REBUILD_SETTLEMENT_SQL, (day, HOME_CURRENCY, start, start + timedelta(days=1)))
+
+
+SETTLEMENT_SQL = """
+    SELECT location_id, currency, amount, n FROM settlement
+    WHERE day=%s AND n > 0
+    ORDER BY location_id, currency
+"""
+
+
+def get_settlement(day):
+    with db_cursor() as cur:
+        cur.execute(SETTLEMENT_SQL, (day,))
+        return cur.fetchall()
+
+
+def get_desks():
+    # location_id -> chat_id desk-a
+    with db_cursor() as cur:
+        cur.execute("SELECT id, desk_chat_id FROM locations WHERE desk_chat_id IS NOT NULL")
+        return dict(cur.fetchall())
+
+
+def set_desk(location_id, chat_id):
+    with db_cursor() as cur:
+        cur.execute("UPDATE locations SET desk_chat_id=%s WHERE id=%s", (chat_id, location_id))
+
+
+def format_settlement(day, rows):
+    by_location = {}
+    for location_id, currency, amount, n in rows:
+        by_location.setdefault(location_id, []).append(f"{amount:.2f} {currency} ({n})")
+
+    msg = f"💰 Stanje za {day:%d.%m.%Y.}\n"
+    if not by_location:
+        return msg + "\nNema otvorenih zahteva."
+
+    for location_id, totals in by_location.items():
+        name = location_catalog.by_id.get(location_id, ("?",))[0]
+        msg += f"\n📍 {name}: " + ", ".join(totals)
+    return msg
+
+
+async def send_settlement(day=None):
+    day = day or await run_db(db_today)
+    rows = await run_db(get_settlement, day)
+    desks = await run_db(get_desks)
+
+    # admin + grupe dobijaju sve lokacije, desk samo svoju
+    notifier.broadcast(format_settlement(day, rows))
+    for location_id, chat_id in desks.items():
+        location_rows = [r for r in rows if r[0] == location_id]
+        if location_rows and chat_id not in NOTIFY_CHAT_IDS:
+            notifier.enqueue(chat_id, format_settlement(day, location_rows))
+
+
+async def settlement_job(ctx):
+    await send_settlement()
+
+
+def schedule_settlement(app):
+    if app.job_queue is None:
+        print("JobQueue nije dostupan (pip install 'python-telegram-bot[job-queue]'), stanje se ne salje.")
+        return
+
+    tz = datetime.now().astimezone().tzinfo
+    for t in SETTLEMENT_TIMES:
+        hh, mm = map(int, t.split(":"))
+        app.job_queue.run_daily(settlement_job, time=dtime(hh, mm, tzinfo=tz), name=f"settlement {t}")
+
+
+# ================= INDEX CHECK ==================
+# cesti upiti (naziv, SQL, primer parametara); check_indexes() proverava da ih
+# planer izvrsava preko indeksa. SQL je isti onaj koji salju helperi, pa lista
+# ne moze da se razidje sa kodom. Na maloj tabeli planer ionako bira seq scan,
+# pa se proverava sa enable_seqscan=off - seq scan tada ostaje samo ako indeksa nema.
+HOT_QUERIES = [
+    ("get_user", GET_USER_SQL, (ADMIN_ID,)),
+    ("users_page_role", *users_page_query(anchor=0, role="USER")),
+    ("locations", ALL_LOCATIONS_SQL, ()),
+    ("rate_history_recent", RECENT_RATE_HISTORY_SQL, (RATE_HISTORY_SIZE,)),
+    ("rate_stats", RATE_STATS_SQL, (DEFAULT_CURRENCY, *rate_periods(datetime(2000, 1, 1)))),
+    ("pending_page", PENDING_PAGE_SQL, (0, PENDING_PAGE_SIZE + 1)),
+    ("pending_count", PENDING_COUNT_SQL, ()),
+    ("decide_request", DECIDE_REQUEST_SQL, ("APPROVED", None, 1)),
+    # provera FK pri brisanju korisnika (delete_user, delete_users) - Postgres je
+    # salje sam, pa nema helpera; treba joj indeks sa created_by na pocetku
+    ("requests_by_user",
+     "SELECT 1 FROM requests WHERE created_by = %s", (ADMIN_ID,)),
+    ("my_requests_page", *user_requests_page_query(ADMIN_ID, anchor=1)),
+    ("rebuild_settlement", REBUILD_SETTLEMENT_SQL,
+     (date(2000, 1, 1), HOME_CURRENCY, datetime(2000, 1, 1), datetime(2000, 1, 2))),
+    ("settlement_day", SETTLEMENT_SQL, (date(2000, 1, 1),)),
+    ("processed_action", PROCESSED_ACTION_SQL, (ADMIN_ID, 1)),
+    ("processed_actions_purge", PROCESSED_ACTIONS_PURGE_SQL, (PROCESSED_ACTIONS_TTL,)),
+    ("state_get", STATE_GET_SQL, ("confirm", ADMIN_ID)),
+    ("state_purge", STATE_PURGE_SQL, ()),
+]
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_indexes():
+    # [(naziv, ok, cvorovi plana)]; ok = nijedna tabela se ne cita seq scan-om
+    results = []
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            for name, sql, params in HOT_QUERIES:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0][0]["Plan"]
+                nodes = [
+                    f"{n['Node Type']} {n.get('Index Name') or n.get('Relation Name', '')}".strip()
+                    for n in _plan_nodes(plan)
+                ]
+                ok = not any(n["Node Type"] == "Seq Scan" for n in _plan_nodes(plan))
+                results.append((name, ok, nodes))
+        # EXPLAIN bez ANALYZE nista ne menja, ali SET LOCAL se vraca
+        con.rollback()
+    return results
+
+
+# ================= AUTH ==================
+
+class BotContext(CallbackContext):
+    # isti context prolazi kroz sve grupe handlera jednog update-a, pa
+    # auth_stage (grupa -1) ovde ostavlja rolu za handlere u grupi 0
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.role = None
+
+
+async def auth_stage(update, ctx):
+    # update stigao pre kraja starta ceka semu i kesevi; predugo -> "pokrece se"
+    if not startup.ready.is_set() and not await startup.wait(STARTUP_WAIT):
+        await reply_starting(update)
+        raise ApplicationHandlerStop
+
+    # jedan lookup role (cache ili baza) po update-u
+    user = update.effective_user
+    ctx.role = await get_role_async(user.id) if user else None
+
+
+def has_role(role, required):
+    if required == "ADMIN":
+        return role == "ADMIN"
+    return role in ("USER", "ADMIN")
+
+
+async def deny_access(update):
+    msg = "❌ Nemate prava pristupa." + admin_contact_text()
+    if update.callback_query:
+        await update.callback_query.answer()
+        return await update.callback_query.edit_message_text(msg, parse_mode="HTML")
+    return await update.message.reply_text(msg, parse_mode="HTML")
+
+
+def requires_role(required, silent=False):
+    # "USER" = bilo koji aktivan korisnik, "ADMIN" = samo admin
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update, ctx):
+            if not has_role(ctx.role, required):
+                if silent:
+                    return
+                return await deny_access(update)
+            return await func(update, ctx)
+
+        wrapper.required_role = required
+        return wrapper
+    return decorator
 
 
 # ================= CONFIRM HANDLER ==================
 
+@requires_role("USER")
 async def confirm_handler(update: Update, ctx):
     query = update.callback_query
     uid = query.from_user.id
     await query.answer()
 
-    if uid not in pending_confirm:
-        return await query.edit_message_text("❌ Nema pending akcije.")
+    button, _, nonce = decode_callback(query.data)
 
-    action = pending_confirm.pop(uid)
+    action = await pending_confirm.get(uid)
+    if action is None or action.get("nonce") != nonce:
+        # dupli klik / ponovljen callback vec izvrsene potvrde - isti odgovor, bez izvrsavanja
+        done, result = await run_db(processed_actions.lookup, uid, nonce)
+        if done:
+            if result:
+                await query.edit_message_text(result)
+            return
 
-    if query.data == "CANCEL":
-        return await query.edit_message_text("❌ Akcija je otkazana.")
+        if action is None:
+            return await query.edit_message_text("❌ Nema pending akcije.")
 
-    con = db()
-    cur = con.cursor()
+        # dugme iz starije poruke - trenutna akcija ostaje da ceka svoju potvrdu
+        return await query.edit_message_text("❌ Ova potvrda je zastarela.")
 
+    # ista potvrda na drugoj instanci ili u istom trenutku - izvrsava samo prvi
+    if not await run_db(processed_actions.claim, uid, nonce):
+        return
+
+    await pending_confirm.pop(uid)
+
+    try:
+        result = "❌ Akcija je otkazana." if button == CB_CANCEL else await execute_action(action, uid, ctx)
+    except Exception:
+        # nista nije izvrseno do kraja - potvrda moze ponovo
+        await run_db(processed_actions.release, uid, nonce)
+        await pending_confirm.set(uid, action)
+        raise
+
+    await run_db(processed_actions.finish, uid, nonce, result)
+    await query.edit_message_text(result)
+
+
+async def execute_action(action, uid, ctx):
+    # izvrsava potvrdjenu akciju i vraca tekst odgovora
     # ===== CONFIRM RATE =====
     if action["type"] == "SET_RATE":
-        buy, sell = action["data"]
-        cur.execute("UPDATE rate SET buy_rate=%s, sell_rate=%s, updated_at=%s, updated_by=%s WHERE id=1",
-                    (buy, sell, datetime.now().isoformat(), uid))
-        con.commit()
-        con.close()
-        return await query.edit_message_text(f"✅ Kurs postavljen\nKupovni={buy}\nProdajni={sell}")
+        currency, buy, sell = action["data"]
+        await run_db(set_rate, buy, sell, uid, currency)
+        return f"✅ Kurs {currency} postavljen\nKupovni={buy}\nProdajni={sell}"
+
+    # ===== CURRENCY LIMITS =====
+    if action["type"] == "SET_CURRENCY":
+        currency, *limits = action["data"]
+        await run_db(set_currency_limits, currency, *limits)
+        return f"✅ Valuta {currency} je sačuvana."
 
     # ===== ADD USER =====
     if action["type"] == "ADD_USER":
         tgid, role, username = action["data"]
-        try:
-            cur.execute("""
-                INSERT INTO users(telegram_id, role, is_active, username)
-                VALUES (%s, %s, 1, %s)
-            """, (tgid, role, username))
-
-            con.commit()
-            return await query.edit_message_text(
-                f"✅ Korisnik je uspešno dodat:\n\n"
-                f"ID: {tgid}\n"
-                f"Role: {role}\n"
-                f"Username: {username}"
-            )
+        added = await run_db(insert_user, tgid, role, username)
+        role_cache.invalidate(tgid)
 
-        except psycopg2.errors.UniqueViolation:
-            return await query.edit_message_text("❌ Korisnik sa tim telegram_id već postoji.")
+        if not added:
+            return "❌ Korisnik sa tim telegram_id već postoji."
 
-        finally:
-            con.close()
+        return (
+            f"✅ Korisnik je uspešno dodat:\n\n"
+            f"ID: {tgid}\n"
+            f"Role: {role}\n"
+            f"Username: {username}"
+        )
 
     # ===== DELETE USER =====
     if action["type"] == "DELETE_USER":
         tgid = action["data"]
-        cur.execute("SELECT telegram_id FROM users WHERE telegram_id=%s", (tgid,))
-        user = cur.fetchone()
+        result = await run_db(delete_user, tgid)
+        role_cache.invalidate(tgid)
 
-        if not user:
-            con.close()
-            return await query.edit_message_text(
-                f"❌ Korisnik sa ID {tgid} ne postoji u bazi."
-            )
+        if not result:
+            return f"❌ Korisnik sa ID {tgid} ne postoji u bazi."
 
-        # delete
-        cur.execute("DELETE FROM users WHERE telegram_id=%s", (tgid,))
-        con.commit()
-        con.close()
+        if result == "DEACTIVATED":
+            return f"✅ Korisnik {tgid} je deaktiviran (ima zahteve ili izmene kursa, pa ne može biti obrisan)."
+
+        return f"✅ Korisnik {tgid} je uspešno obrisan."
 
-        return await query.edit_message_text(f"✅ Korisnik {tgid} je uspešno obrisan.")
+    # ===== BULK IMPORT / DELETE =====
+    if action["type"] == "IMPORT_USERS":
+        rows = action["data"]
+        added, inactive = await run_db(insert_users, rows)
+        for tgid, *_ in rows:
+            role_cache.invalidate(tgid)
+
+        return (
+            f"✅ Uvezeno korisnika: {added}"
+            + (f" (neaktivnih: {inactive})" if inactive else "") + "\n"
+            f"Preskočeno (već postoje): {len(rows) - added}"
+        )
+
+    if action["type"] == "DELETE_USERS":
+        tgids = action["data"]
+        deleted, deactivated = await run_db(delete_users, tgids)
+        for tgid in tgids:
+            role_cache.invalidate(tgid)
+
+        return (
+            f"✅ Obrisano korisnika: {deleted}\n"
+            f"Deaktivirano (imaju zahteve ili izmene kursa): {deactivated}\n"
+            f"Nije pronađeno: {len(tgids) - deleted - deactivated}"
+        )
 
     # ===== ADD LOCATION =====
     if action["type"] == "ADD_LOCATION":
         name = action["data"]
-        cur.execute("INSERT INTO locations(name) VALUES(%s) ON CONFLICT (name) DO NOTHING", (name,))
-        con.commit()
-        con.close()
-        return await query.edit_message_text(f"✅ Lokacija {name} je uspešno dodata.")
+        await run_db(insert_location, name)
+        return f"✅ Lokacija {name} je uspešno dodata."
 
     # ===== CONFIRM REQUEST =====
     if action["type"] == "USER_REQUEST":
-        msg = action["data"]
+        msg = action["data"]["msg"]
+
+        # upis ide u batch, ne cekamo ga
+        fut = request_writer.submit(uid, *action["data"]["request"])
+
+        # admin + grupe (sa Odobri/Odbij kad stigne id); salje se u pozadini, korisnik ne ceka
+        ctx.application.create_task(announce_request(fut, msg, uid))
 
-        # send adminu
-        await ctx.bot.send_message(ADMIN_ID, msg)
+        return "✅ Zahtev je primljen i šalje se adminu i u grupu."
 
-        # send u grupu
-        GROUP_ID = -5021696516
-        await ctx.bot.send_message(GROUP_ID, msg)
 
-        con.close()
-        return await query.edit_message_text("✅ Zahtev je poslat adminu i u grupu.")
+async def stale_button_handler(update: Update, ctx):
+    # dugmad u starom formatu (pre promene callback_data) ili nepoznata
+    await update.callback_query.answer("⚠️ Ovo dugme više ne važi.")
 
 
 # ================= COMMANDS ADMIN ==================
 
 def private_only(func):
+    @wraps(func)
     async def wrapper(update, ctx):
         if update.effective_chat.type != "private":
             return  # ignorise komande iz grupa
@@ -240,16 +2332,22 @@ def admin_contact_text():
     return f'\n\n📩 <a href="tg://user?id={ADMIN_ID}">Kontaktirajte admina</a>'
 
 
-def confirm_keyboard():
+def confirm_keyboard(nonce):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Potvrdi", callback_data="CONFIRM")],
-        [InlineKeyboardButton("❌ Otkaži", callback_data="CANCEL")]
+        [InlineKeyboardButton("✅ Potvrdi", callback_data=encode_callback(CB_CONFIRM, nonce=nonce))],
+        [InlineKeyboardButton("❌ Otkaži", callback_data=encode_callback(CB_CANCEL, nonce=nonce))]
     ])
 
 
+async def ask_confirm(uid, action):
+    # pamti akciju sa novim nonce-om; dugmad iz ranijih poruka vise ne vaze
+    action["nonce"] = new_nonce()
+    await pending_confirm.set(uid, action)
+    return confirm_keyboard(action["nonce"])
+
+
 async def unknown_command(update, ctx):
-    uid = update.effective_user.id
-    role = get_role(uid)
+    role = ctx.role
 
     if not role:
         return await update.message.reply_text(
@@ -276,20 +2374,50 @@ def get_admin_commands():
         /kurs_evra BUY_RATE SELL_RATE  
         ➡️ Postavlja dnevni kupovni i prodajni kurs evra i pamti vreme izmene.
 
+        /kurs VALUTA BUY_RATE SELL_RATE  
+        ➡️ Postavlja kurs dodate valute (RSD za 1 jedinicu); bez argumenata prikazuje sve kurseve.
+
+        /valuta VALUTA MIN_BUY MAX_BUY MIN_SPREAD MAX_SPREAD  
+        ➡️ Dodaje valutu ili menja granice za unos njenog kursa.
+
+        /kurs_istorija [VALUTA]  
+        ➡️ Min/max/prosek kursa i spread za danas i ovu nedelju, uz poslednje izmene.
+
+        /moji_zahtevi  
+        ➡️ Vaši poslednji zahtevi i njihov status.
+
         /add TELEGRAM_ID ROLE USERNAME
         ➡️ Dodaje novog korisnika u sistem.
 
         /delete TELEGRAM_ID  
         ➡️ Briše korisnika iz sistema.
 
-        /list_users  
-        ➡️ Prikazuje sve korisnike u bazi.
+        CSV fajl (telegram_id,role,username[,is_active])  
+        ➡️ Dodaje više korisnika odjednom; sa caption-om delete ih briše.
+
+        /export_users  
+        ➡️ Šalje sve korisnike kao CSV fajl.
+
+        /list_users [USER|ADMIN] [active|inactive]  
+        ➡️ Prikazuje korisnike u bazi, po stranicama (opciono filter po roli/statusu).
 
         /add_location NAZIV_LOKACIJE  
         ➡️ Dodaje novu lokaciju.
 
-        /list_locations  
-        ➡️ Prikazuje sve lokacije i njihov status (active/deactivated).
+        /list_locations [POČETAK_NAZIVA]  
+        ➡️ Prikazuje lokacije i njihov status (active/deactivated), po stranicama ili pretragom.
+
+        /pending  
+        ➡️ Zahtevi koji čekaju odobrenje, sa dugmadima Odobri/Odbij.
+
+        /stanje  
+        ➡️ Koliko koja lokacija treba da spremi danas, po valuti.
+
+        /desk CHAT_ID NAZIV_LOKACIJE  
+        ➡️ Grupa koja automatski dobija stanje lokacije.
+
+        /db_stats  
+        ➡️ Prikazuje stanje DB poola (konekcije, čekanje, korišćenje).
 
         /help  
         ➡️ Lista komandi dostupnih adminu.
@@ -298,13 +2426,10 @@ def get_admin_commands():
 
 
 async def admin_start(update, ctx):
-    uid = update.effective_user.id
-    role = get_role(uid)
-
     print("USER ID:", update.effective_user.id)
 
     # ako nije admin → prebaci na user start
-    if role != "ADMIN":
+    if ctx.role != "ADMIN":
         return await start(update, ctx)
 
     msg = """
@@ -315,20 +2440,50 @@ async def admin_start(update, ctx):
         /kurs_evra BUY_RATE SELL_RATE  
         ➡️ Postavlja dnevni kupovni i prodajni kurs evra i pamti vreme izmene.
 
+        /kurs VALUTA BUY_RATE SELL_RATE  
+        ➡️ Postavlja kurs dodate valute (RSD za 1 jedinicu); bez argumenata prikazuje sve kurseve.
+
+        /valuta VALUTA MIN_BUY MAX_BUY MIN_SPREAD MAX_SPREAD  
+        ➡️ Dodaje valutu ili menja granice za unos njenog kursa.
+
+        /kurs_istorija [VALUTA]  
+        ➡️ Min/max/prosek kursa i spread za danas i ovu nedelju, uz poslednje izmene.
+
+        /moji_zahtevi  
+        ➡️ Vaši poslednji zahtevi i njihov status.
+
         /add TELEGRAM_ID ROLE USERNAME  
         ➡️ Dodaje novog korisnika u sistem.
 
         /delete TELEGRAM_ID  
         ➡️ Briše korisnika iz sistema.
 
-        /list_users  
-        ➡️ Prikazuje sve korisnike u bazi.
+        CSV fajl (telegram_id,role,username[,is_active])  
+        ➡️ Dodaje više korisnika odjednom; sa caption-om delete ih briše.
+
+        /export_users  
+        ➡️ Šalje sve korisnike kao CSV fajl.
+
+        /list_users [USER|ADMIN] [active|inactive]  
+        ➡️ Prikazuje korisnike u bazi, po stranicama (opciono filter po roli/statusu).
 
         /add_location NAZIV_LOKACIJE  
         ➡️ Dodaje novu lokaciju.
 
-        /list_locations  
-        ➡️ Prikazuje sve lokacije i njihov status (active/deactivated).
+        /list_locations [POČETAK_NAZIVA]  
+        ➡️ Prikazuje lokacije i njihov status (active/deactivated), po stranicama ili pretragom.
+
+        /pending  
+        ➡️ Zahtevi koji čekaju odobrenje, sa dugmadima Odobri/Odbij.
+
+        /stanje  
+        ➡️ Koliko koja lokacija treba da spremi danas, po valuti.
+
+        /desk CHAT_ID NAZIV_LOKACIJE  
+        ➡️ Grupa koja automatski dobija stanje lokacije.
+
+        /db_stats  
+        ➡️ Prikazuje stanje DB poola (konekcije, čekanje, korišćenje).
 
         /help  
         ➡️ Lista komandi dostupnih adminu.
@@ -336,37 +2491,80 @@ async def admin_start(update, ctx):
     await update.message.reply_text(msg)
 
 
-async def kurs_set(update, ctx):
-    if not is_admin(update.effective_user.id):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
+USERNAME_RE = re.compile(r"^[a-zA-Z0-9_]{3,32}$")
+
 
+def parse_user(tgid, role, username):
+    # ((telegram_id, role, username), None) ili (None, poruka greske)
     try:
-        buy = float(ctx.args[0])
-        sell = float(ctx.args[1])
-    except:
-        return await update.message.reply_text("Format: /kurs_evra BUY_RATE SELL_RATE")
+        tgid = int(tgid)
+    except ValueError:
+        return None, "❌ TELEGRAM_ID mora biti broj."
+
+    role = role.upper()
+    if role not in ["USER", "ADMIN"]:
+        return None, "❌ Role mora biti USER ili ADMIN."
+
+    if not USERNAME_RE.match(username):
+        return None, "❌ Username mora imati 3-32 karaktera (slova, brojevi, _)."
+
+    return (tgid, role, username), None
+
+
+def parse_users_csv(content, delete=False):
+    # CSV telegram_id,role,username[,is_active] (za brisanje samo telegram_id), zaglavlje
+    # je opciono; is_active (0/1, kao u /export_users) je podrazumevano 1.
+    # Vraca (redovi, greske); za brisanje redovi su samo ID-jevi
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return [], ["Fajl mora biti UTF-8 CSV."]
+
+    columns = 1 if delete else 3
+    rows, errors, seen = [], [], set()
+    for line_no, cells in enumerate(csv.reader(io.StringIO(text)), start=1):
+        cells = [c.strip() for c in cells]
+        if not any(cells):
+            continue
+        if line_no == 1 and not cells[0].isdigit():
+            continue  # zaglavlje
+
+        if len(cells) < columns:
+            errors.append(f"Red {line_no}: očekivano kolona: {columns}.")
+            continue
+
+        if delete:
+            user, error = parse_user(cells[0], "USER", "placeholder")
+        else:
+            user, error = parse_user(*cells[:3])
+        if error:
+            errors.append(f"Red {line_no}: {error[2:]}")
+            continue
+
+        if not delete:
+            active = cells[3] if len(cells) > 3 and cells[3] else "1"
+            if active not in ("0", "1"):
+                errors.append(f"Red {line_no}: is_active mora biti 0 ili 1.")
+                continue
+            user = (*user, int(active))
+
+        if user[0] in seen:
+            errors.append(f"Red {line_no}: TELEGRAM_ID {user[0]} se ponavlja.")
+            continue
+        seen.add(user[0])
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("""
-        UPDATE rate 
-        SET buy_rate=%s, sell_rate=%s, updated_at=%s, updated_by=%s
-        WHERE id=1
-    """, (buy, sell, datetime.now().isoformat(), update.effective_user.id))
+        rows.append(user[0] if delete else user)
 
-    con.commit()
-    con.close()
+    if len(rows) > IMPORT_MAX_ROWS:
+        errors.append(f"Najviše {IMPORT_MAX_ROWS} redova po fajlu.")
 
-    await update.message.reply_text("✅ Dnevni kurs evra je ažuriran.")
+    return rows, errors
 
 
+@requires_role("ADMIN")
 async def add_user(update, ctx):
     uid = update.effective_user.id
 
-    # only admin
-    if not is_admin(uid):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
     if len(ctx.args) < 3:
         return await update.message.reply_text(
             "❌ Neispravan format:\n\n"
@@ -374,95 +2572,304 @@ async def add_user(update, ctx):
             "Primer: /add 123456789 USER petar\n"
         )
 
-    # parse args
-    try:
-        tgid = int(ctx.args[0])
-    except ValueError:
-        return await update.message.reply_text("❌ TELEGRAM_ID mora biti broj.")
+    user, error = parse_user(*ctx.args[:3])
+    if error:
+        return await update.message.reply_text(error)
+
+    tgid, role, username = user
+    keyboard = await ask_confirm(uid, {"type": "ADD_USER", "data": (tgid, role, username)})
+
+    await update.message.reply_text(
+        f"Dodati korisnika?\nID={tgid}\nRole={role}\nUsername={username}\n\n"
+        f"Klikni potvrdi ili otkaži.",
+        reply_markup=keyboard
+    )
+
+
+@requires_role("ADMIN")
+async def del_user(update, ctx):
+    uid = update.effective_user.id
+
+    # format check
+    if len(ctx.args) != 1:
+        return await update.message.reply_text(
+            "❌ Neispravan format.\n\n"
+            "/delete TELEGRAM_ID\n"
+            "Primer:\n"
+            "/delete 123456789"
+        )
+
+    # parse telegram_id
+    try:
+        tgid = int(ctx.args[0])
+    except ValueError:
+        return await update.message.reply_text("❌ TELEGRAM_ID mora biti broj.")
+
+    # admin ne sme da obrise sebe
+    if tgid == uid:
+        return await update.message.reply_text("❌ Ne možeš obrisati samog sebe.")
+
+    keyboard = await ask_confirm(uid, {"type": "DELETE_USER", "data": tgid})
+
+    await update.message.reply_text(
+        f"Obrisati user {tgid}?\n\n"
+        f"Klikni potvrdi ili otkaži.",
+        reply_markup=keyboard
+    )
+
+
+@requires_role("ADMIN", silent=True)
+async def import_users(update, ctx):
+    # CSV dokument: telegram_id,role,username[,is_active] -> bulk /add
+    # sa caption-om "delete": telegram_id po redu -> bulk /delete
+    uid = update.effective_user.id
+    document = update.message.document
+    delete = (update.message.caption or "").strip().lower() == "delete"
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        return await update.message.reply_text(f"❌ Fajl je veći od {IMPORT_MAX_BYTES // 1024} KB.")
+
+    file = await document.get_file()
+    content = bytes(await file.download_as_bytearray())
+
+    rows, errors = parse_users_csv(content, delete)
+    if delete and uid in rows:
+        errors.append("Ne možeš obrisati samog sebe.")
+
+    if errors:
+        shown = "\n".join(errors[:10])
+        more = f"\n... i još {len(errors) - 10} grešaka" if len(errors) > 10 else ""
+        return await update.message.reply_text(
+            f"❌ Fajl nije uvezen, ispravite greške:\n\n{shown}{more}\n\n"
+            "Format (CSV): telegram_id,role,username[,is_active]\n"
+            "Za brisanje: CSV sa telegram_id i caption delete."
+        )
+
+    if not rows:
+        return await update.message.reply_text("❌ Fajl ne sadrži nijednog korisnika.")
+
+    if delete:
+        keyboard = await ask_confirm(uid, {"type": "DELETE_USERS", "data": rows})
+        return await update.message.reply_text(
+            f"Obrisati {len(rows)} korisnika?\n\n"
+            f"Klikni potvrdi ili otkaži.",
+            reply_markup=keyboard
+        )
+
+    admins = sum(1 for _, role, _, _ in rows if role == "ADMIN")
+    preview = "\n".join(
+        f"{tgid} {role} {username}" + ("" if active else " (neaktivan)")
+        for tgid, role, username, active in rows[:5]
+    )
+    if len(rows) > 5:
+        preview += "\n..."
+
+    keyboard = await ask_confirm(uid, {"type": "IMPORT_USERS", "data": rows})
+    await update.message.reply_text(
+        f"Dodati {len(rows)} korisnika (USER: {len(rows) - admins}, ADMIN: {admins})?\n\n"
+        f"{preview}\n\n"
+        f"Klikni potvrdi ili otkaži.",
+        reply_markup=keyboard
+    )
+
+
+@requires_role("ADMIN")
+async def export_users(update, ctx):
+    with tempfile.NamedTemporaryFile(suffix=".csv") as f:
+        await run_db(export_users_csv, f)
+        f.seek(0)
+        await update.message.reply_document(
+            f, filename=f"users_{datetime.now():%Y%m%d_%H%M}.csv"
+        )
+
+
+@requires_role("ADMIN")
+async def list_users(update, ctx):
+    role = None
+    active = None
+
+    for arg in ctx.args:
+        a = arg.upper()
+        if a in ("USER", "ADMIN"):
+            role = a
+        elif a in ("ACTIVE", "INACTIVE"):
+            active = 1 if a == "ACTIVE" else 0
+        else:
+            return await update.message.reply_text(
+                "❌ Neispravan format.\n\n"
+                "/list_users [USER|ADMIN] [active|inactive]\n"
+                "Primer: /list_users USER active"
+            )
+
+    msg, keyboard = await users_page(None, "N", role, active)
+    await update.message.reply_text(msg, reply_markup=keyboard, parse_mode="HTML")
+
+
+async def users_page(anchor, direction, role, active):
+    rows, has_more = await run_db(get_users_page, anchor, direction == "P", role, active)
+
+    filters_text = " ".join(x for x in (role, {1: "active", 0: "inactive"}.get(active)) if x)
+    lines = [f"👥 Lista korisnika{' (' + filters_text + ')' if filters_text else ''}:\n"]
+    for tgid, r, username, is_active in rows:
+        status = "" if is_active else " (neaktivan)"
+        lines.append(f"• ID: <code>{tgid}</code>{status}\n  Role: {r}\n  Username: @{username}\n")
+
+    if not rows:
+        lines.append("Nema korisnika.")
+
+    # prev postoji ako smo krenuli od anchor-a unapred, ili ako unazad ima jos
+    has_prev = has_more if direction == "P" else anchor is not None
+    has_next = has_more if direction == "N" else anchor is not None
+
+    f = f"{role or '-'}:{'-' if active is None else active}"
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prethodna", callback_data=f"USERS:P:{rows[0][0]}:{f}"))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton("Sledeća ➡️", callback_data=f"USERS:N:{rows[-1][0]}:{f}"))
+
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@requires_role("ADMIN")
+async def users_page_handler(update: Update, ctx):
+    query = update.callback_query
+    await query.answer()
+
+    _, direction, anchor, role, active = query.data.split(":")
+    role = None if role == "-" else role
+    active = None if active == "-" else int(active)
+
+    msg, keyboard = await users_page(int(anchor), direction, role, active)
+    await query.edit_message_text(msg, reply_markup=keyboard, parse_mode="HTML")
+
+
+async def pending_page(anchor=0):
+    rows, has_more, total = await run_db(get_pending_page, anchor)
+
+    lines = [f"📥 Zahtevi na čekanju: {total}\n"]
+    keyboard = []
+    for request_id, amount, currency, target, rate, due_time, location_id, created_by, username in rows:
+        location = location_catalog.by_id.get(location_id, ("?",))[0]
+        lines.append(
+            f"#{request_id}: {amount} {currency} → {target or '?'} po {rate}, "
+            f"rok {due_time}, {location}, @{username or created_by}"
+        )
+        keyboard.append(request_keyboard(request_id, from_list=True))
+
+    if not rows:
+        lines.append("Nema zahteva na čekanju.")
+
+    if has_more:
+        keyboard.append([InlineKeyboardButton("Sledeća ➡️", callback_data=f"PENDING:{rows[-1][0]}")])
+
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+@requires_role("ADMIN")
+async def pending(update, ctx):
+    msg, keyboard = await pending_page()
+    await update.message.reply_text(msg, reply_markup=keyboard)
+
+
+@requires_role("ADMIN")
+async def pending_page_handler(update: Update, ctx):
+    query = update.callback_query
+    await query.answer()
+
+    msg, keyboard = await pending_page(int(query.data.split(":")[1]))
+    await query.edit_message_text(msg, reply_markup=keyboard)
+
+
+async def request_decision_handler(update: Update, ctx):
+    query = update.callback_query
 
-    role = ctx.args[1].upper()
-    username = ctx.args[2]
+    # dugmad su i u grupama; ne-admin ne sme da izmeni poruku (deny_access bi je prepisao)
+    if not has_role(ctx.role, "ADMIN"):
+        return await query.answer("❌ Samo admin može da odobri ili odbije zahtev.")
 
-    # validate role
-    if role not in ["USER", "ADMIN"]:
-        return await update.message.reply_text("❌ Role mora biti USER ili ADMIN.")
+    action, request_id, _ = decode_callback(query.data)
+    status = "APPROVED" if action in (CB_APPROVE, CB_APPROVE_LIST) else "REJECTED"
+    from_list = action in (CB_APPROVE_LIST, CB_REJECT_LIST)
+    admin = query.from_user.username or query.from_user.id
 
-    if not re.match(r"^[a-zA-Z0-9_]{3,32}$", username):
-        return await update.message.reply_text(
-            "❌ Username mora imati 3-32 karaktera (slova, brojevi, _)."
+    created_by, current = await run_db(decide_request, request_id, status, f"{status} by @{admin}")
+
+    if created_by is None:
+        await query.answer(f"Zahtev #{request_id} je već obrađen ({current or 'ne postoji'}).")
+    else:
+        await query.answer()
+        recent_requests.invalidate(created_by)
+        notifier.enqueue(
+            created_by,
+            f"✅ Vaš zahtev #{request_id} je odobren." if status == "APPROVED"
+            else f"❌ Vaš zahtev #{request_id} je odbijen."
         )
 
-    pending_confirm[uid] = {"type": "ADD_USER", "data": (tgid, role, username)}
+    if from_list:
+        msg, keyboard = await pending_page()
+        return await query.edit_message_text(msg, reply_markup=keyboard)
 
-    await update.message.reply_text(
-        f"Dodati korisnika?\nID={tgid}\nRole={role}\nUsername={username}\n\n"
-        f"Klikni potvrdi ili otkaži.",
-        reply_markup=confirm_keyboard()
-    )
+    label = "✅ ODOBRENO" if status == "APPROVED" else "❌ ODBIJENO"
+    if created_by is None:
+        label = f"ℹ️ Već obrađeno: {current}"
+    await query.edit_message_text(f"{query.message.text}\n\n{label} (@{admin})")
 
 
-async def del_user(update, ctx):
-    uid = update.effective_user.id
+@requires_role("ADMIN")
+async def stanje(update, ctx):
+    day = await run_db(db_today)
+    rows = await run_db(get_settlement, day)
+    await update.message.reply_text(format_settlement(day, rows))
 
-    # permission check
-    if not is_admin(uid):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
 
-    # format check
-    if len(ctx.args) != 1:
+@requires_role("ADMIN")
+async def desk(update, ctx):
+    # /desk CHAT_ID NAZIV_LOKACIJE (CHAT_ID 0 = bez desk-a)
+    if len(ctx.args) < 2:
         return await update.message.reply_text(
-            "❌ Neispravan format.\n\n"
-            "/delete TELEGRAM_ID\n"
-            "Primer:\n"
-            "/delete 123456789"
+            "Format: /desk CHAT_ID NAZIV_LOKACIJE\n"
+            "Primer: /desk -1001234567890 Beograd\n"
+            "CHAT_ID 0 uklanja desk."
         )
 
-    # parse telegram_id
     try:
-        tgid = int(ctx.args[0])
+        chat_id = int(ctx.args[0])
     except ValueError:
-        return await update.message.reply_text("❌ TELEGRAM_ID mora biti broj.")
+        return await update.message.reply_text("❌ CHAT_ID mora biti broj.")
 
-    # admin ne sme da obrise sebe
-    if tgid == uid:
-        return await update.message.reply_text("❌ Ne možeš obrisati samog sebe.")
-
-    pending_confirm[uid] = {"type": "DELETE_USER", "data": tgid}
+    name = " ".join(ctx.args[1:])
+    location_id = location_catalog.by_name.get(name)
+    if location_id is None:
+        return await update.message.reply_text("❌ Lokacija ne postoji.")
 
+    await run_db(set_desk, location_id, chat_id or None)
     await update.message.reply_text(
-        f"Obrisati user {tgid}?\n\n"
-        f"Klikni potvrdi ili otkaži.",
-        reply_markup=confirm_keyboard()
+        f"✅ Desk za {name}: {chat_id}" if chat_id else f"✅ {name} više nema desk."
     )
 
 
-async def list_users(update, ctx):
-    uid = update.effective_user.id
-
-    # permission check
-    if not is_admin(uid):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT telegram_id, role, username FROM users")
-    rows = cur.fetchall()
-    con.close()
+@requires_role("ADMIN")
+async def db_stats(update, ctx):
+    st = pool_stats()
+    checkouts = st["checkouts"] or 1
 
-    msg = "👥 Lista korisnika:\n\n"
-    for tgid, role, username in rows:
-        msg += f"• ID: <code>{tgid}</code>\n  Role: {role}\n  Username: @{username}\n\n"
-
-    await update.message.reply_text(msg, parse_mode="HTML")
+    await update.message.reply_text(
+        f"🗄 DB pool:\n\n"
+        f"Veličina: {st['min_size']}-{st['max_size']}\n"
+        f"U upotrebi: {st['in_use']} (max {st['max_in_use']})\n"
+        f"Checkout-a: {st['checkouts']}\n"
+        f"Čekanje avg/max: {st['wait_seconds_total'] / checkouts * 1000:.1f} / {st['wait_seconds_max'] * 1000:.1f} ms\n"
+        f"Korišćenje avg/max: {st['use_seconds_total'] / checkouts * 1000:.1f} / {st['use_seconds_max'] * 1000:.1f} ms\n"
+        f"Timeout-a: {st['timeouts']}\n"
+        f"Odbačenih konekcija: {st['discarded']}"
+    )
 
 
+@requires_role("ADMIN")
 async def add_location(update, ctx):
     uid = update.effective_user.id
 
-    # permission check
-    if not is_admin(uid):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
     # format check
     if not ctx.args:
         return await update.message.reply_text(
@@ -473,136 +2880,172 @@ async def add_location(update, ctx):
 
     name = " ".join(ctx.args)
 
-    pending_confirm[uid] = {"type": "ADD_LOCATION", "data": name}
+    keyboard = await ask_confirm(uid, {"type": "ADD_LOCATION", "data": name})
 
     await update.message.reply_text(
         f"Dodati lokaciju: {name}?\n\n"
         "Klikni potvrdi ili otkaži.",
-        reply_markup=confirm_keyboard()
+        reply_markup=keyboard
     )
 
 
-def admin_locations_keyboard(rows):
+def admin_locations_keyboard(rows, page=0, pages=1):
     keyboard = []
 
     for loc_id, name, active in rows:
         if active:
             btn_text = f"🛑 Disable {name}"
-            action = "DISABLE"
+            action = CB_LOC_DISABLE
         else:
             btn_text = f"▶️ Enable {name}"
-            action = "ENABLE"
+            action = CB_LOC_ENABLE
 
         keyboard.append([
             InlineKeyboardButton(
                 btn_text,
-                callback_data=f"ADMIN_LOC_{action}:{loc_id}"
+                callback_data=encode_callback(action, loc_id)
             )
         ])
 
-    return InlineKeyboardMarkup(keyboard)
-
+    nav = nav_row("ADMIN_LOCPG:", page, pages)
+    if nav:
+        keyboard.append(nav)
 
-async def list_locations(update, ctx):
-    uid = update.effective_user.id
-
-    if not is_admin(uid):
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, is_active FROM locations ORDER BY is_active DESC, name")
-    rows = cur.fetchall()
-    con.close()
+    return InlineKeyboardMarkup(keyboard)
 
-    if not rows:
-        return await update.message.reply_text("⚠️ Nema lokacija u bazi.")
 
-    msg = "📍 *LISTA LOKACIJA*\n\n"
+def admin_locations_text(rows, page=0, pages=1):
+    msg = "📍 *LISTA LOKACIJA*"
+    if pages > 1:
+        msg += f" ({page + 1}/{pages})"
+    msg += "\n\n"
 
     for loc_id, name, active in rows:
         if active:
-            msg += f"🟢 *{name}* \n"
+            msg += f"🟢 *{name}*\n"
         else:
-            msg += f"🔴 {name} \n"
+            msg += f"🔴 {name}\n"
 
     msg += "\nKlikni dugme ispod za enable/disable."
+    return msg
+
+
+@requires_role("ADMIN")
+async def list_locations(update, ctx):
+    catalog = location_catalog
+    if not catalog.rows:
+        return await update.message.reply_text("⚠️ Nema lokacija u bazi.")
+
+    # /list_locations PREFIKS - pretraga po pocetku naziva
+    if ctx.args:
+        rows, more = catalog.search(" ".join(ctx.args), active_only=False)
+        if not rows:
+            return await update.message.reply_text("⚠️ Nema lokacija koje počinju sa tim nazivom.")
+
+        msg = admin_locations_text(rows)
+        if more:
+            msg += f"\n\nPrikazano prvih {LOCATIONS_PAGE_SIZE}, suzite pretragu."
+        return await update.message.reply_text(
+            msg,
+            reply_markup=admin_locations_keyboard(rows),
+            parse_mode="Markdown"
+        )
 
+    text, keyboard = catalog.admin_page(0)
     await update.message.reply_text(
-        msg,
-        reply_markup=admin_locations_keyboard(rows),
+        text,
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
 
 
-async def admin_location_toggle_handler(update: Update, ctx):
+@requires_role("ADMIN")
+async def admin_location_page_handler(update: Update, ctx):
     query = update.callback_query
-    uid = query.from_user.id
     await query.answer()
 
-    if not is_admin(uid):
-        return await query.edit_message_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
-    # ===== ENABLE / DISABLE =====
-    action, loc_id = query.data.replace("ADMIN_LOC_", "").split(":")
-    loc_id = int(loc_id)
-
-    con = db()
-    cur = con.cursor()
+    if not location_catalog.admin_pages:
+        return await query.edit_message_text("⚠️ Nema lokacija u bazi.")
 
-    if action == "ENABLE":
-        cur.execute("UPDATE locations SET is_active=1 WHERE id=%s", (loc_id,))
-    else:
-        cur.execute("UPDATE locations SET is_active=0 WHERE id=%s", (loc_id,))
+    text, keyboard = location_catalog.admin_page(int(query.data.split(":")[1]))
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    except BadRequest:
+        pass  # klik na trenutnu stranicu - poruka se nije promenila
 
-    con.commit()
 
-    # ===== RELOAD LOCATIONS =====
-    cur.execute("SELECT id, name, is_active FROM locations ORDER BY is_active DESC, name")
-    rows = cur.fetchall()
-    con.close()
+@requires_role("ADMIN")
+async def admin_location_toggle_handler(update: Update, ctx):
+    query = update.callback_query
+    await query.answer()
 
-    # rebuild text
-    msg = "📍 *LISTA LOKACIJA*\n\n"
-    for loc_id, name, active in rows:
-        if active:
-            msg += f"🟢 *{name}*\n"
-        else:
-            msg += f"🔴 {name}\n"
+    # ===== ENABLE / DISABLE =====
+    action, loc_id, _ = decode_callback(query.data)
 
-    msg += "\nKlikni dugme ispod za aktivaciju/deaktivaciju."
+    # upis + ponovno pravljenje kataloga
+    await run_db(set_location_active, loc_id, action == CB_LOC_ENABLE)
 
-    # EDIT FULL MESSAGE (TEXT + BUTTONS)
+    # EDIT FULL MESSAGE (TEXT + BUTTONS) - stranica na kojoj je lokacija sada
+    text, keyboard = location_catalog.admin_page(location_catalog.admin_page_of(loc_id))
     await query.edit_message_text(
-        msg,
-        reply_markup=admin_locations_keyboard(rows),
+        text,
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
 
 
+@requires_role("ADMIN", silent=True)
 async def admin_help(update, ctx):
-    if not is_admin(update.effective_user.id):
-        return
     msg = """
         Dostupne komande:
 
         /kurs_evra BUY_RATE SELL_RATE  
         ➡️ Postavlja dnevni kupovni i prodajni kurs evra i pamti vreme izmene.
 
+        /kurs VALUTA BUY_RATE SELL_RATE  
+        ➡️ Postavlja kurs dodate valute (RSD za 1 jedinicu); bez argumenata prikazuje sve kurseve.
+
+        /valuta VALUTA MIN_BUY MAX_BUY MIN_SPREAD MAX_SPREAD  
+        ➡️ Dodaje valutu ili menja granice za unos njenog kursa.
+
+        /kurs_istorija [VALUTA]  
+        ➡️ Min/max/prosek kursa i spread za danas i ovu nedelju, uz poslednje izmene.
+
+        /moji_zahtevi  
+        ➡️ Vaši poslednji zahtevi i njihov status.
+
         /add TELEGRAM_ID ROLE USERNAME
         ➡️ Dodaje novog korisnika u sistem.
 
         /delete TELEGRAM_ID  
         ➡️ Briše korisnika iz sistema.
 
-        /list_users  
-        ➡️ Prikazuje sve korisnike u bazi.
+        CSV fajl (telegram_id,role,username[,is_active])  
+        ➡️ Dodaje više korisnika odjednom; sa caption-om delete ih briše.
+
+        /export_users  
+        ➡️ Šalje sve korisnike kao CSV fajl.
+
+        /list_users [USER|ADMIN] [active|inactive]  
+        ➡️ Prikazuje korisnike u bazi, po stranicama (opciono filter po roli/statusu).
 
         /add_location NAZIV_LOKACIJE  
         ➡️ Dodaje novu lokaciju.
 
-        /list_locations  
-        ➡️ Prikazuje sve lokacije i njihov status (active/deactivated).
+        /list_locations [POČETAK_NAZIVA]  
+        ➡️ Prikazuje lokacije i njihov status (active/deactivated), po stranicama ili pretragom.
+
+        /pending  
+        ➡️ Zahtevi koji čekaju odobrenje, sa dugmadima Odobri/Odbij.
+
+        /stanje  
+        ➡️ Koliko koja lokacija treba da spremi danas, po valuti.
+
+        /desk CHAT_ID NAZIV_LOKACIJE  
+        ➡️ Grupa koja automatski dobija stanje lokacije.
+
+        /db_stats  
+        ➡️ Prikazuje stanje DB poola (konekcije, čekanje, korišćenje).
         """
     await update.message.reply_text(msg)
 
@@ -619,23 +3062,26 @@ def get_user_commands():
 
        Primer:
        1000,EUR,117.2,18.00
+       1000 EUR 117,2 18h
 
        Zatim birate lokaciju i potvrđujete zahtev.
+
+       /kurs  
+       ➡️ Prikazuje kurseve svih valuta (npr. zahtev 100,USD/EUR,0.92,18.00).
+
+       /kurs_istorija [VALUTA]  
+       ➡️ Min/max/prosek kursa i spread za danas i ovu nedelju.
+
+       /moji_zahtevi  
+       ➡️ Vaši poslednji zahtevi i njihov status.
        """
     )
 
 
+@requires_role("USER")
 async def start(update, ctx):
-    uid = update.effective_user.id
-    role = get_role(uid)
-
-    if not role:
-        return await update.message.reply_text(
-            "❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML"
-        )
-
     # ako je admin, prebaci na admin_start
-    if role == "ADMIN":
+    if ctx.role == "ADMIN":
         return await admin_start(update, ctx)
 
     msg = """
@@ -650,17 +3096,24 @@ async def start(update, ctx):
 
         Primer:
         1000,EUR,117.2,18.00
+        1000 EUR 117,2 18h
 
         Zatim birate lokaciju i potvrđujete zahtev.
+
+        /kurs  
+        ➡️ Prikazuje kurseve svih valuta (npr. zahtev 100,USD/EUR,0.92,18.00).
+
+        /kurs_istorija [VALUTA]  
+        ➡️ Min/max/prosek kursa i spread za danas i ovu nedelju.
+
+        /moji_zahtevi  
+        ➡️ Vaši poslednji zahtevi i njihov status.
         """
     await update.message.reply_text(msg)
 
 
+@requires_role("USER")
 async def kurs_get(update, ctx):
-    role = get_role(update.effective_user.id)
-    if not role:
-        return await update.message.reply_text("❌ Nemate prava pristupa." + admin_contact_text(), parse_mode="HTML")
-
     k = get_rate()
     if not k:
         return await update.message.reply_text("❌ Kurs nije postavljen." + admin_contact_text(), parse_mode="HTML")
@@ -700,11 +3153,40 @@ async def kurs_get(update, ctx):
     )
 
 
-async def kurs_evra(update, ctx):
-    uid = update.effective_user.id
+def format_rate_stats(title, stats):
+    if not stats:
+        return f"{title}: nema izmena kursa.\n"
+
+    n, buy_min, buy_max, buy_avg, sell_min, sell_max, sell_avg, spread_min, spread_max, spread_avg = stats
+    return (
+        f"{title} ({n} izmena):\n"
+        f"Kupovni: min {buy_min:.2f} / max {buy_max:.2f} / prosek {buy_avg:.2f}\n"
+        f"Prodajni: min {sell_min:.2f} / max {sell_max:.2f} / prosek {sell_avg:.2f}\n"
+        f"Spread: min {spread_min:.2f} / max {spread_max:.2f} / prosek {spread_avg:.2f}\n"
+    )
 
+
+@requires_role("USER")
+async def kurs_istorija(update, ctx):
+    currency = ctx.args[0].upper() if ctx.args else DEFAULT_CURRENCY
+    stats = await run_db(get_rate_stats, currency, datetime.now())
+
+    msg = f"📈 Istorija kursa {currency}\n\n"
+    msg += format_rate_stats("Danas", stats.get("day")) + "\n"
+    msg += format_rate_stats("Ova nedelja", stats.get("week")) + "\n"
+
+    recent = rate_history.recent(currency, RATE_HISTORY_SHOWN)
+    if recent:
+        msg += "Poslednje izmene:\n"
+        for buy, sell, updated_at in reversed(recent):
+            msg += f"{updated_at:%d.%m. %H:%M}  {buy} / {sell}\n"
+
+    await update.message.reply_text(msg)
+
+
+async def kurs_evra(update, ctx):
     # USER MODE
-    if not is_admin(uid):
+    if ctx.role != "ADMIN":
         return await kurs_get(update, ctx)
 
     # ADMIN MODE
@@ -713,8 +3195,11 @@ async def kurs_evra(update, ctx):
             "Format: /kurs_evra BUY SELL\nPrimer: /kurs_evra 117.2 118.0"
         )
 
-    buy_str = ctx.args[0]
-    sell_str = ctx.args[1]
+    await ask_set_rate(update, DEFAULT_CURRENCY, *ctx.args)
+
+
+async def ask_set_rate(update, currency, buy_str, sell_str):
+    uid = update.effective_user.id
 
     # Provera da li korisnik koristi zarez
     if "," in buy_str or "," in sell_str:
@@ -729,124 +3214,283 @@ async def kurs_evra(update, ctx):
     except ValueError:
         return await update.message.reply_text("❌ Kurs mora biti broj.")
 
-    # ===== BASIC LOGIC CHECK =====
-    if buy >= sell:
-        return await update.message.reply_text("❌ Kupovni kurs mora biti manji od prodajnog.")
-
-    # ===== RANGE CHECK =====
-    if not (MIN_BUY_RATE <= buy <= MAX_BUY_RATE):
-        return await update.message.reply_text(
-            f"❌ Kupovni kurs mora biti između {MIN_BUY_RATE} i {MAX_BUY_RATE} RSD."
-        )
-
-    spread = sell - buy
-    if not (MIN_SPREAD <= spread <= MAX_SPREAD):
-        return await update.message.reply_text(
-            f"❌ Razlika kupovni/prodajni mora biti između {MIN_SPREAD} i {MAX_SPREAD}."
-        )
+    error = validate_rate(currency, buy, sell)
+    if error:
+        return await update.message.reply_text(error)
 
     # SAVE TEMP
-    pending_confirm[uid] = {"type": "SET_RATE", "data": (buy, sell)}
+    keyboard = await ask_confirm(uid, {"type": "SET_RATE", "data": (currency, buy, sell)})
 
     await update.message.reply_text(
-        f"⚠️ Potvrdi novi kurs:\n\n"
+        f"⚠️ Potvrdi novi kurs {currency}:\n\n"
         f"Kupovni: {buy}\n"
         f"Prodajni: {sell}\n\n"
         f"Klikni potvrdi ili otkaži.",
-        reply_markup=confirm_keyboard()
+        reply_markup=keyboard
     )
 
 
-def validate_request(parts):
-    try:
-        iznos = float(parts[0])
-    except:
-        return "❌ Iznos mora biti broj."
+@requires_role("USER")
+async def kurs(update, ctx):
+    # ADMIN: /kurs VALUTA BUY SELL; bez argumenata svi kursevi
+    if ctx.args:
+        if ctx.role != "ADMIN":
+            return await update.message.reply_text("Format: /kurs")
+        if len(ctx.args) != 3:
+            return await update.message.reply_text(
+                "Format: /kurs VALUTA BUY SELL\nPrimer: /kurs USD 106.5 108.0"
+            )
+        return await ask_set_rate(update, ctx.args[0].upper(), ctx.args[1], ctx.args[2])
+
+    rates = rate_book.rates
+    if not rates:
+        return await update.message.reply_text("❌ Kurs nije postavljen." + admin_contact_text(), parse_mode="HTML")
+
+    msg = f"💱 Kursevi ({HOME_CURRENCY} za 1 jedinicu):\n\n"
+    for currency in sorted(rates):
+        buy, sell, updated_at = rates[currency]
+        msg += f"{currency}: {buy} / {sell}  ({updated_at:%d.%m. %H:%M})\n"
+
+    msg += (
+        "\nZahtev u drugoj valuti:\n"
+        "100,USD,107.2,18.00 (USD -> RSD)\n"
+        "100,USD/EUR,0.92,18.00 (kros kurs, EUR za 1 USD)"
+    )
+    await update.message.reply_text(msg)
 
-    # ===== VALUTA =====
-    valuta = parts[1].upper()
-    if valuta not in ["EUR", "RSD"]:
-        return "❌ Valuta mora biti EUR ili RSD."
+
+@requires_role("ADMIN")
+async def valuta(update, ctx):
+    uid = update.effective_user.id
+
+    if len(ctx.args) != 5:
+        return await update.message.reply_text(
+            "Format: /valuta VALUTA MIN_BUY MAX_BUY MIN_SPREAD MAX_SPREAD\n"
+            "Primer: /valuta USD 100 115 0.1 4"
+        )
+
+    currency = ctx.args[0].upper()
+    if not CURRENCY_RE.match(currency) or currency == HOME_CURRENCY:
+        return await update.message.reply_text("❌ Valuta mora biti troslovni kod, npr. USD.")
 
     try:
-        kurs = float(parts[2])
-    except:
+        min_buy, max_buy, min_spread, max_spread = map(float, ctx.args[1:])
+    except ValueError:
+        return await update.message.reply_text("❌ Granice moraju biti brojevi.")
+
+    if not (0 < min_buy <= max_buy and 0 <= min_spread <= max_spread):
+        return await update.message.reply_text("❌ Neispravne granice (MIN mora biti manji od MAX).")
+
+    keyboard = await ask_confirm(uid, {
+        "type": "SET_CURRENCY",
+        "data": (currency, min_buy, max_buy, min_spread, max_spread),
+    })
+
+    await update.message.reply_text(
+        f"Sačuvati valutu {currency}?\n"
+        f"Kupovni kurs: {min_buy} - {max_buy} RSD\n"
+        f"Spread: {min_spread} - {max_spread}\n\n"
+        f"Klikni potvrdi ili otkaži.",
+        reply_markup=keyboard
+    )
+
+
+# zahtev korisnika: IZNOS VALUTA[/VALUTA] KURS ROK; rok 18.00, 18:00, 18h ili 18.
+# Zarez je ili separator polja ili decimalni zarez, nikad oba: kad su polja odvojena
+# zarezom brojevi moraju imati tacku ("1,000,EUR,..." se odbija, ne cita kao 1.0);
+# decimalni zarez je dozvoljen samo kad su polja odvojena razmakom ili ";".
+_NUM_DOT = r"\d+(?:\.\d+)?"
+_NUM = r"\d+(?:[.,]\d+)?"
+_COMMA_SEP = r"\s*,\s*"
+_SEP = r"(?:\s*;\s*|\s+)"
+
+
+def _request_re(num, sep):
+    return re.compile(
+        rf"\s*(?P<amount>{num}){sep}"
+        rf"(?P<frm>[A-Za-z]{{3}})(?:\s*/\s*(?P<to>[A-Za-z]{{3}}))?{sep}"
+        rf"(?P<rate>{num}){sep}"
+        rf"(?P<hh>\d{{1,2}})(?:[.:h](?P<mm>\d{{2}}))?\s*h?\s*"
+    )
+
+
+REQUEST_COMMA_RE = _request_re(_NUM_DOT, _COMMA_SEP)  # 1000,EUR,117.2,18.00
+REQUEST_RE = _request_re(_NUM, _SEP)                 # 1000 EUR 117,2 18h / 1000; EUR; 117,2; 18.00
+COMMA_SEP_RE = re.compile(_COMMA_SEP)
+REQUEST_SEP_RE = re.compile(_SEP)
+FIELD_SEP_RE = re.compile(r"[;\s]")
+NUMBER_DOT_RE = re.compile(_NUM_DOT)
+NUMBER_RE = re.compile(_NUM)
+PAIR_RE = re.compile(r"[A-Za-z]{3}(?:/[A-Za-z]{3})?")
+REQUEST_FORMAT_HELP = "\n\nIspravan format:\n1000,EUR,117.2,18.00\nili: 1000 EUR 117,2 18h"
+
+# u pending_requests se cuva kao lista (JSON), rok je uvek HH.MM
+ParsedRequest = namedtuple("ParsedRequest", "amount frm to rate due_time")
+
+
+def looks_like_request(text):
+    # ono sto nije pretraga lokacije ni slucajan tekst
+    return "," in text or text[:1].isdigit()
+
+
+def parse_request(text):
+    # jedan prolaz kroz precompiled gramatiku; (ParsedRequest, None) ili (None, poruka)
+    m = REQUEST_COMMA_RE.fullmatch(text) or REQUEST_RE.fullmatch(text)
+    if m is None:
+        return None, request_format_error(text)
+
+    frm = m["frm"].upper()
+    to = m["to"].upper() if m["to"] else (DEFAULT_CURRENCY if frm == HOME_CURRENCY else HOME_CURRENCY)
+    if frm == to:
+        return None, "❌ Valuta mora biti npr. EUR, RSD, USD ili par USD/EUR."
+
+    hh, mm = int(m["hh"]), int(m["mm"] or 0)
+    if hh > 23 or mm > 59:
+        return None, "❌ Vreme mora biti između 00.00 i 23.59."
+
+    return ParsedRequest(
+        float(m["amount"].replace(",", ".")), frm, to,
+        float(m["rate"].replace(",", ".")), f"{hh:02d}.{mm:02d}",
+    ), None
+
+
+def request_format_error(text):
+    # samo za neispravan unos: koje polje ne valja
+    text = text.strip()
+    if "," in text and not FIELD_SEP_RE.search(COMMA_SEP_RE.sub(",", text)):
+        # polja odvojena zarezom - zarez u iznosu/kursu bi pomerio polja
+        parts, number = COMMA_SEP_RE.split(text), NUMBER_DOT_RE
+        if len(parts) > 4:
+            return (
+                "❌ Iznos i kurs ne smeju sadržati zarez (,) kada su polja odvojena zarezom.\n"
+                "Koristite tačku (117.25) ili odvojite polja razmakom (1000 EUR 117,25 18h)."
+            )
+    else:
+        parts, number = REQUEST_SEP_RE.split(text), NUMBER_RE
+
+    if len(parts) != 4:
+        return "❌ Neispravan format."
+    if not number.fullmatch(parts[0]):
+        return "❌ Iznos mora biti broj."
+    if not PAIR_RE.fullmatch(parts[1]):
+        return "❌ Valuta mora biti npr. EUR, RSD, USD ili par USD/EUR."
+    if not number.fullmatch(parts[2]):
         return "❌ Kurs mora biti broj."
+    return "❌ Rok mora biti u formatu HH.MM (ili 18h).\nPrimer: 15.00"
+
+
+def validate_request(req):
+    # samo memorija (rate_book), bez I/O
+    if req.amount <= 0:
+        return "❌ Iznos mora biti veći od nule."
 
     # ===== PROVERA KURSA PREMA ADMIN POSTAVLJENOM =====
-    current_rate = get_rate()  # (buy, sell, updated_at)
-    if current_rate is None:
-        return "❌ Kurs nije postavljen."
+    quote = rate_book.quote(req.frm, req.to)  # (buy, sell), iz memorije
+    if quote is None:
+        return f"❌ Kurs za {req.frm}/{req.to} nije postavljen."
 
-    buy, sell, _ = current_rate
-    if not (buy <= kurs <= sell):
+    buy, sell = round(quote[0], 4), round(quote[1], 4)
+    if not (buy <= req.rate <= sell):
         return f"❌ Kurs mora biti između trenutnog kupovnog i prodajnog kursa:\nKupovni={buy}, Prodajni={sell}"
 
-    # ===== VREME VALIDACIJA =====
-    time_str = parts[3]
+    return None
 
-    # Ako je uneo :
-    if ":" in time_str:
-        return "❌ Vreme mora biti u formatu HH.MM (koristite tačku, ne dvotačku).\nPrimer: 15.00"
 
-    # Regex za HH.MM
-    if not re.match(r"^\d{2}\.\d{2}$", time_str):
-        return "❌ Vreme mora biti u formatu HH.MM.\nPrimer: 15.00"
+REQUEST_STATUS_TEXT = {
+    "DRAFT": "📝 nacrt",
+    "SENT": "⏳ na čekanju",
+    "APPROVED": "✅ odobren",
+    "REJECTED": "❌ odbijen",
+}
 
-    hh, mm = map(int, time_str.split("."))
-    if not (0 <= hh <= 23 and 0 <= mm <= 59):
-        return "❌ Vreme mora biti između 00.00 i 23.59."
 
-    return None
+async def my_requests_page(uid, anchor=None):
+    # prva stranica iz recent_requests (ponovljen /moji_zahtevi bez upita), ostale iz baze
+    if anchor is None:
+        page = recent_requests.get(uid)
+        if page is _MISSING:
+            page = await run_db(get_user_requests_page, uid)
+            recent_requests.set(uid, page)
+    else:
+        page = await run_db(get_user_requests_page, uid, anchor)
+    rows, has_more = page
+
+    lines = ["🧾 Vaši zahtevi:\n"]
+    for request_id, amount, currency, target, rate, due_time, location_id, status, created_at in rows:
+        location = location_catalog.by_id.get(location_id, ("?",))[0]
+        lines.append(
+            f"#{request_id} ({created_at:%d.%m. %H:%M}): {amount} {currency} → {target or '?'} po {rate}, "
+            f"rok {due_time}, {location} - {REQUEST_STATUS_TEXT.get(status, status)}"
+        )
 
+    if not rows:
+        lines.append("Nemate poslatih zahteva." if anchor is None else "Nema starijih zahteva.")
 
-# ================= MESSAGE FLOW ==================
+    keyboard = None
+    if has_more:
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Starije ➡️", callback_data=f"MYREQ:{rows[-1][0]}")]])
+    return "\n".join(lines), keyboard
+
+
+@requires_role("USER")
+async def moji_zahtevi(update, ctx):
+    msg, keyboard = await my_requests_page(update.effective_user.id)
+    await update.message.reply_text(msg, reply_markup=keyboard)
+
+
+@requires_role("USER", silent=True)
+async def my_requests_page_handler(update: Update, ctx):
+    query = update.callback_query
+    await query.answer()
 
-pending_requests = {}
+    msg, keyboard = await my_requests_page(query.from_user.id, int(query.data.split(":")[1]))
+    await query.edit_message_text(msg, reply_markup=keyboard)
 
 
+# ================= MESSAGE FLOW ==================
+
+@requires_role("USER", silent=True)
 async def handle_text(update, ctx):
     if update.effective_chat.type != "private":
         return  # ne reaguje na poruke u grupi
 
     uid = update.effective_user.id
-    role = get_role(uid)
-    if not role:
-        return
 
     text = update.message.text
+    pending = await pending_requests.contains(uid)
 
-    # parse input
-    if "," in text and uid not in pending_requests:
-        parts = [p.strip() for p in text.split(",")]
+    is_request = looks_like_request(text)
 
-        if len(parts) < 4:
+    # pretraga lokacija dok zahtev ceka izbor lokacije
+    if pending and not is_request:
+        rows, more = location_catalog.search(text)
+        if not rows:
             return await update.message.reply_text(
-                "❌ Neispravan format.\n"
-                "Primer:\n1000,EUR,117.2,18.00"
+                "⚠️ Nema lokacije koja počinje sa tim nazivom.",
+                reply_markup=location_catalog.user_page(0)
             )
 
-        if len(parts) > 4:
-            return await update.message.reply_text(
-                "❌ Iznos i kurs ne smeju sadržati zarez (,).\n"
-                "Koristite tačku (.) kao decimalni separator.\n"
-                "Primer: 117.25"
+        return await update.message.reply_text(
+            "📍 Rezultati pretrage:" + ("\n(prikazani su prvi rezultati, suzite pretragu)" if more else ""),
+            reply_markup=user_locations_keyboard(
+                [(loc_id, name) for loc_id, name, _ in rows],
+                extra_row=[InlineKeyboardButton("📋 Sve lokacije", callback_data="LOCPG:0")],
             )
+        )
 
-        error = validate_request(parts)
+    # parse input
+    if is_request and not pending:
+        req, error = parse_request(text)
+        if req is not None:
+            error = validate_request(req)
         if error:
-            return await update.message.reply_text(
-                error + "\n\nIspravan format:\n1000,EUR,117.2,18.00"
-            )
+            return await update.message.reply_text(error + REQUEST_FORMAT_HELP)
 
-        pending_requests[uid] = parts
-
-        locs = get_locations()
-        keyboard = [[InlineKeyboardButton(l, callback_data=f"LOC_{l}")] for l in locs]
+        await pending_requests.set(uid, list(req))
 
         await update.message.reply_text(
-            "📍 Izaberite lokaciju:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            "📍 Izaberite lokaciju (ili upišite početak naziva za pretragu):",
+            reply_markup=location_catalog.user_page(0)
         )
         return
 
@@ -854,80 +3498,346 @@ async def handle_text(update, ctx):
     return await update.message.reply_text(
         "❗ Sve komande moraju početi sa /\n\n"
         "Dostupne komande:\n" +
-        (get_admin_commands() if is_admin(uid) else get_user_commands())
+        (get_admin_commands() if ctx.role == "ADMIN" else get_user_commands())
     )
 
 
+@requires_role("USER")
+async def location_page_handler(update: Update, ctx):
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        await query.edit_message_reply_markup(location_catalog.user_page(int(query.data.split(":")[1])))
+    except BadRequest:
+        pass  # klik na trenutnu stranicu - tastatura se nije promenila
+
+
+@requires_role("USER")
 async def location_handler(update: Update, ctx):
     query = update.callback_query
     uid = query.from_user.id
     await query.answer()
 
-    if not query.data.startswith("LOC_"):
-        return
-
-    location = query.data.replace("LOC_", "")
-    data = pending_requests.pop(uid)
+    _, location_id, _ = decode_callback(query.data)
+    location, active = location_catalog.by_id.get(location_id, (None, False))
+    if not active:
+        return await query.edit_message_text(
+            "❌ Lokacija više nije aktivna. Izaberite drugu:",
+            reply_markup=location_catalog.user_page(0)
+        )
 
-    iznos, valuta, kurs, rok = data
-    iznos_f = float(iznos)
-    kurs_f = float(kurs)
+    data = await pending_requests.pop(uid)
+    if data is None:
+        # dupli klik na lokaciju - poruka vec ceka potvrdu, ne prepisuje se
+        if await pending_confirm.contains(uid):
+            return
+        return await query.edit_message_text("❌ Zahtev je istekao. Unesite ga ponovo.")
 
-    if valuta.upper() == "EUR":
-        spremiti = iznos_f * kurs_f
-        spremiti_valuta = "RSD"
-    else:
-        spremiti = iznos_f / kurs_f
-        spremiti_valuta = "EUR"
+    iznos_f, donosi, spremiti_valuta, kurs_f, rok = ParsedRequest(*data)
+    spremiti = convert(iznos_f, donosi, spremiti_valuta, kurs_f)
 
     msg = (
         f"📩 Novi zahtev:\n\n"
         f"Klijentu spremiti: {spremiti:.2f} {spremiti_valuta}\n"
-        f"Klijent donosi: {iznos_f} {valuta.upper()}\n"
+        f"Klijent donosi: {iznos_f} {donosi}\n"
         f"Lokacija: {location}\n"
         f"Rok: {rok}\n"
         f"Kreirao: @{query.from_user.username} ({uid})"
     )
 
-    pending_confirm[uid] = {"type": "USER_REQUEST", "data": msg}
+    keyboard = await ask_confirm(uid, {
+        "type": "USER_REQUEST",
+        "data": {
+            "msg": msg,
+            "request": (iznos_f, donosi, kurs_f, rok, location_id, spremiti_valuta),
+        },
+    })
 
     await query.edit_message_text(
         msg + "\n\nPotvrdi slanje adminu:",
-        reply_markup=confirm_keyboard()
+        reply_markup=keyboard
     )
 
 
+# ================= STARTUP ==================
+
+class Startup:
+    # faze starta (sekundi) i spremnost. U lazy modu update-ovi stizu pre nego sto su
+    # sema i kesevi spremni, pa auth_stage ceka na ready (najvise STARTUP_WAIT)
+
+    def __init__(self, t0):
+        self.t0 = t0
+        self._last_mark = t0
+        self.phases = {}  # faza -> trajanje
+        self.ready = asyncio.Event()
+        self.ready_at = None  # sekundi od importa
+        self.first_reply = None
+        self.task = None
+
+    def timed(self, phase, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.phases[phase] = time.perf_counter() - t0
+
+    def mark(self, phase):
+        # faza od prethodne oznake do sada (import, build_app, initialize)
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last_mark
+        self._last_mark = now
+
+    def set_ready(self):
+        self.ready_at = time.perf_counter() - self.t0
+        self.ready.set()
+        print("Start: " + ", ".join(f"{k} {v:.2f}s" for k, v in self.phases.items())
+              + f" -> spreman posle {self.ready_at:.2f}s")
+        if self.ready_at > STARTUP_BUDGET:
+            print(f"⚠️ Start je trajao {self.ready_at:.2f}s (budzet {STARTUP_BUDGET}s)")
+
+    def mark_first_reply(self):
+        self.first_reply = time.perf_counter() - self.t0
+        print(f"Prvi odgovor posle {self.first_reply:.2f}s od starta")
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def report_items(self):
+        items = list(self.phases.items())
+        if self.ready_at is not None:
+            items.append(("ready", self.ready_at))
+        if self.first_reply is not None:
+            items.append(("first_reply", self.first_reply))
+        return items
+
+
+startup = Startup(IMPORT_STARTED)
+
+
+def prefetch_roles():
+    # role aktivnih korisnika u role_cache, da prvi update-ovi ne idu u bazu
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT telegram_id, role FROM users WHERE is_active=1 ORDER BY telegram_id LIMIT %s",
+            (ROLE_CACHE_SIZE,)
+        )
+        rows = cur.fetchall()
+    for uid, role in rows:
+        role_cache.set(uid, role)
+
+
+def warm_up_sync():
+    # eager start: isti koraci kao warm_up, redom
+    startup.timed("pool", get_pool)
+    startup.timed("schema", init_db)
+    startup.timed("rate", load_rate)
+    startup.timed("locations", location_catalog.reload)
+    startup.timed("roles", prefetch_roles)
+    startup.timed("settlement", rebuild_settlement)
+    if CACHE_LISTEN:
+        start_cache_listener()
+    startup.mark("warm_up")
+    startup.set_ready()
+
+
+async def warm_up():
+    # lazy start: pool i sema, pa kesevi paralelno; ponavlja dok baza ne odgovori
+    while True:
+        try:
+            await run_db(startup.timed, "pool", get_pool)
+            await run_db(startup.timed, "schema", init_db)
+            await asyncio.gather(
+                run_db(startup.timed, "rate", load_rate),
+                run_db(startup.timed, "locations", location_catalog.reload),
+                run_db(startup.timed, "roles", prefetch_roles),
+                run_db(startup.timed, "settlement", rebuild_settlement),
+            )
+            break
+        except Exception as e:
+            print(f"Priprema baze nije uspela ({e!r}), novi pokusaj za {STARTUP_RETRY}s")
+            await asyncio.sleep(STARTUP_RETRY)
+
+    if CACHE_LISTEN:
+        start_cache_listener()
+    startup.set_ready()
+
+
+async def reply_starting(update):
+    msg = "⏳ Bot se upravo pokreće, pokušajte ponovo za nekoliko sekundi."
+    if update.callback_query:
+        await update.callback_query.answer(msg, show_alert=True)
+    elif update.effective_message and update.effective_chat.type == "private":
+        await update.effective_message.reply_text(msg)
+
+
 # ================= MAIN ==================
 
-def main():
-    init_db()
-    app = Application.builder().token(TOKEN).build()
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # update-ovi razlicitih korisnika se obradjuju paralelno, a istog korisnika
+    # redom (npr. potvrda ne sme da pretekne izbor lokacije). Lock korisnika se
+    # uzima pre semafora, da korisnik koji ceka na sebe ne zauzima slot.
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}  # uid -> [lock, broj update-ova koji ga koriste]
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return await super().process_update(update, coroutine)
+
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def post_init(app):
+    request_writer.start()
+    notifier.start(app.bot)
+    startup.mark("initialize")
+    # lazy start: polling/webhook krece odmah posle post_init, baza se sprema u pozadini
+    if not startup.ready.is_set() and startup.task is None:
+        startup.task = asyncio.get_running_loop().create_task(warm_up())
+
+
+async def post_shutdown(app):
+    if startup.task is not None and not startup.task.done():
+        startup.task.cancel()
+    await notifier.stop()
+    await request_writer.stop()
+
+
+def build_app(request=None):
+    # request: zamena za HTTP sloj ka Telegram-u (bench.py koristi lazni API)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .context_types(ContextTypes(context=BotContext))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if request is None:
+        request = HTTPXRequest(connection_pool_size=256)
+        updates_request = HTTPXRequest()
+    else:
+        updates_request = request
+    builder = builder.request(InstrumentedRequest(request)).get_updates_request(InstrumentedRequest(updates_request))
+    app = builder.build()
+    schedule_settlement(app)
+
+    # rola se odredjuje jednom, pre svih handlera
+    app.add_handler(TypeHandler(Update, auth_stage), group=-1)
 
     # start
     app.add_handler(CommandHandler("start", private_only(start)))
 
     # kurs
     app.add_handler(CommandHandler("kurs_evra", private_only(kurs_evra)))
+    app.add_handler(CommandHandler("kurs_istorija", private_only(kurs_istorija)))
+    app.add_handler(CommandHandler("moji_zahtevi", private_only(moji_zahtevi)))
+    app.add_handler(CommandHandler("kurs", private_only(kurs)))
+    app.add_handler(CommandHandler("valuta", private_only(valuta)))
 
     # admin komande
     app.add_handler(CommandHandler("add", private_only(add_user)))
     app.add_handler(CommandHandler("delete", private_only(del_user)))
     app.add_handler(CommandHandler("list_users", private_only(list_users)))
+    app.add_handler(CommandHandler("export_users", private_only(export_users)))
     app.add_handler(CommandHandler("add_location", private_only(add_location)))
     app.add_handler(CommandHandler("list_locations", private_only(list_locations)))
+    app.add_handler(CommandHandler("pending", private_only(pending)))
+    app.add_handler(CommandHandler("stanje", private_only(stanje)))
+    app.add_handler(CommandHandler("desk", private_only(desk)))
+    app.add_handler(CommandHandler("db_stats", private_only(db_stats)))
     app.add_handler(CommandHandler("help", private_only(admin_help)))
 
-    app.add_handler(CallbackQueryHandler(admin_location_toggle_handler, pattern="^ADMIN_LOC_"))
-    app.add_handler(CallbackQueryHandler(location_handler, pattern="^LOC_"))
-    app.add_handler(CallbackQueryHandler(confirm_handler))
+    app.add_handler(CallbackQueryHandler(
+        admin_location_toggle_handler, pattern=callback_pattern(CB_LOC_ENABLE, CB_LOC_DISABLE)
+    ))
+    app.add_handler(CallbackQueryHandler(admin_location_page_handler, pattern="^ADMIN_LOCPG:"))
+    app.add_handler(CallbackQueryHandler(location_page_handler, pattern="^LOCPG:"))
+    app.add_handler(CallbackQueryHandler(users_page_handler, pattern="^USERS:"))
+    app.add_handler(CallbackQueryHandler(pending_page_handler, pattern="^PENDING:"))
+    app.add_handler(CallbackQueryHandler(my_requests_page_handler, pattern="^MYREQ:"))
+    app.add_handler(CallbackQueryHandler(
+        request_decision_handler,
+        pattern=callback_pattern(CB_APPROVE, CB_REJECT, CB_APPROVE_LIST, CB_REJECT_LIST)
+    ))
+    app.add_handler(CallbackQueryHandler(location_handler, pattern=callback_pattern(CB_LOC)))
+    app.add_handler(CallbackQueryHandler(confirm_handler, pattern=callback_pattern(CB_CONFIRM, CB_CANCEL)))
+    app.add_handler(CallbackQueryHandler(stale_button_handler))
 
     # text handler
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") | filters.Document.MimeType("text/csv"),
+        private_only(import_users)
+    ))
 
     app.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
-    print("Bot started...")
-    app.run_polling()
+    instrument_app(app)
+    return app
+
+
+def check_config():
+    # pogresna podesavanja - prekini odmah, pre baze i Telegrama
+    if BOT_MODE not in ("polling", "webhook"):
+        raise SystemExit(f"BOT_MODE mora biti polling ili webhook, a ne {BOT_MODE!r}")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook trazi WEBHOOK_URL (javni URL aplikacije)")
+    if STARTUP_MODE not in ("lazy", "eager"):
+        raise SystemExit(f"STARTUP_MODE mora biti lazy ili eager, a ne {STARTUP_MODE!r}")
+
+
+def main():
+    check_config()
+    startup.mark("import")
+    if STARTUP_MODE == "eager":
+        warm_up_sync()
+
+    app = build_app()
+    startup.mark("build_app")
+    if METRICS_PORT:
+        start_metrics_server()
+
+    print(f"Bot started ({BOT_MODE})...")
+    try:
+        if BOT_MODE == "webhook":
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            app.run_polling()
+    finally:
+        close_pool()
 
 
 if __name__ == "__main__":